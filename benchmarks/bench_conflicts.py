@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure how often concurrent replies to one thread conflict on the
+referents of its root, with a single ``TreeSet`` and with a
+:class:`.ShardedTreeSet`.
+
+Each round opens several connections to the same database, adds a new
+(random) intid to the root's referents in each, and commits them one
+after the other, so that all but the first commit have to resolve
+against the others. The conflict rate is the fraction of commits that
+raise a ``ConflictError``.
+
+Run with ``python benchmarks/bench_conflicts.py``. This requires ZODB.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import random
+import shutil
+import tempfile
+
+import BTrees
+
+import transaction
+
+from ZODB import DB
+
+from ZODB.FileStorage import FileStorage
+
+from ZODB.POSException import ConflictError
+
+from nti.threadable.datastructures import ShardedTreeSet
+
+WRITERS = 4
+ROUNDS = 250
+INITIAL = 2000
+MAX_INTID = 2 ** 40
+
+SETS = (
+    ('TreeSet', BTrees.family64.II.TreeSet),
+    ('Sharded (4)', lambda: ShardedTreeSet(4)),
+    ('Sharded (8)', lambda: ShardedTreeSet(8)),
+    ('Sharded (32)', lambda: ShardedTreeSet(32)),
+)
+
+
+def conflict_rate(factory, directory):
+    db = DB(FileStorage(os.path.join(directory, '%s.fs' % id(factory))))
+    try:
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        referents = factory()
+        referents.update(random.sample(range(MAX_INTID), INITIAL))
+        conn.root()['referents'] = referents
+        tm.commit()
+        conn.close()
+
+        conflicts = 0
+        for _ in range(ROUNDS):
+            writers = []
+            for _ in range(WRITERS):
+                tm = transaction.TransactionManager()
+                conn = db.open(tm)
+                conn.root()['referents'].add(random.randrange(MAX_INTID))
+                writers.append((tm, conn))
+            for tm, conn in writers:
+                try:
+                    tm.commit()
+                except ConflictError:
+                    conflicts += 1
+                    tm.abort()
+                conn.close()
+        return conflicts / (ROUNDS * WRITERS)
+    finally:
+        db.close()
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    try:
+        print('%14s %14s' % ('referents', 'conflict rate'))
+        for name, factory in SETS:
+            print('%14s %13.2f%%' % (name, conflict_rate(factory, directory) * 100))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of adding (and removing) a reply as a function of
+the depth of the thread it is added to.
+
+Each depth is measured twice: once with the stored ancestor chains
+that the subscribers maintain, and once with those chains cleared so
+that every insert has to chase the ``inReplyTo`` pointers to the root.
+
+Run with ``python benchmarks/bench_depth.py``.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from timeit import default_timer
+
+import BTrees
+
+from persistent import Persistent
+
+from zope import component
+
+from zope.configuration import xmlconfig
+
+from zope.intid.interfaces import IIntIds
+
+import nti.threadable
+
+from nti.threadable.subscribers import threadable_added
+from nti.threadable.subscribers import threadable_removed
+
+from nti.threadable.threadable import Threadable
+
+DEPTHS = (1, 10, 50, 100, 250, 500, 1000)
+INSERTS = 200
+
+
+class Post(Persistent, Threadable):
+    """
+    A threadable that can be weakly referenced, as real ones can.
+    """
+
+
+class IntIds(object):
+    """
+    A minimal, in-memory intid utility.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self):
+        self._objects = {}
+        self._ids = {}
+        self._next = 1
+
+    def register(self, obj):
+        self._objects[self._next] = obj
+        self._ids[id(obj)] = self._next
+        self._next += 1
+        return obj
+
+    def unregister(self, obj):
+        doc_id = self._ids.pop(id(obj))
+        del self._objects[doc_id]
+
+    def queryId(self, obj, default=None):
+        return self._ids.get(id(obj), default)
+
+    def getId(self, obj):
+        return self._ids[id(obj)]
+
+    def queryObject(self, doc_id, default=None):
+        return self._objects.get(doc_id, default)
+
+    def getObject(self, doc_id):
+        return self._objects[doc_id]
+
+
+def add(intids, parent=None):
+    obj = intids.register(Post())
+    obj.inReplyTo = parent
+    threadable_added(obj, None)
+    return obj
+
+
+def build_chain(intids, depth):
+    leaf = add(intids)
+    for _ in range(depth):
+        leaf = add(intids, leaf)
+    return leaf
+
+
+def time_inserts(intids, leaf, chains):
+    if not chains:
+        leaf._ancestor_ids = None
+    begin = default_timer()
+    for _ in range(INSERTS):
+        reply = add(intids, leaf)
+        threadable_removed(reply, None)
+        intids.unregister(reply)
+    return (default_timer() - begin) / INSERTS
+
+
+def main():
+    xmlconfig.file('configure.zcml', package=nti.threadable)
+    intids = IntIds()
+    component.getGlobalSiteManager().registerUtility(intids, IIntIds)
+
+    print('%6s %18s %18s' % ('depth', 'chain (us/insert)', 'walk (us/insert)'))
+    for depth in DEPTHS:
+        leaf = build_chain(intids, depth)
+        chain = time_inserts(intids, leaf, True)
+        walk = time_inserts(intids, leaf, False)
+        print('%6d %18.1f %18.1f' % (depth, chain * 1e6, walk * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of maintaining and reading threads at scale.
+
+A wide thread (a root with :data:`WIDTH` direct replies) and a deep
+thread (a chain :data:`DEPTH` replies long) are built in an in-memory
+ZODB (``MappingStorage``) with a small persistent intid utility. Each
+operation starts with an empty object cache, so reads include loading
+the objects they need.
+
+Timings use pyperf; run with ``python benchmarks/bench_threads.py``
+(add ``--fast`` for a quick run, or ``-o results.json`` and then
+``python -m pyperf compare_to`` to compare runs). With ``--counts``,
+each operation is instead run once and the number of objects it
+loaded and stored, and the size of the pickles it wrote, are
+reported.
+
+This requires the ``benchmarks`` extra.
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from timeit import default_timer
+
+import BTrees
+
+import pyperf
+
+import transaction
+
+from persistent import Persistent
+
+from ZODB import DB
+
+from ZODB.MappingStorage import MappingStorage
+
+from zope import component
+from zope import interface
+
+from zope.configuration import xmlconfig
+
+from zope.intid.interfaces import IIntIds
+
+from nti.externalization.datastructures import InterfaceObjectIO
+
+import nti.threadable
+
+from nti.threadable.externalization import ThreadableExternalizableMixin
+
+from nti.threadable.subscribers import threadable_added
+from nti.threadable.subscribers import threadable_removed
+
+from nti.threadable.threadable import Threadable
+
+#: The number of direct replies of the root of the wide thread
+WIDTH = 10000
+
+#: The number of levels of the deep thread
+DEPTH = 1000
+
+
+class IPost(interface.Interface):
+    pass
+
+
+@interface.implementer(IPost)
+class Post(Persistent, Threadable):
+    createdTime = 0
+
+
+class PostIO(ThreadableExternalizableMixin, InterfaceObjectIO):
+    _ext_iface_upper_bound = IPost
+
+
+class IntIds(Persistent):
+    """
+    A minimal persistent intid utility. The intid of each object is
+    stored on the object.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self):
+        super(IntIds, self).__init__()
+        self.refs = self.family.IO.BTree()
+        self.next_id = 1
+
+    def register(self, obj):
+        obj._bench_intid = self.next_id
+        self.refs[self.next_id] = obj
+        self.next_id += 1
+        return obj
+
+    def unregister(self, obj):
+        del self.refs[obj._bench_intid]
+        del obj._bench_intid
+
+    def queryId(self, obj, default=None):
+        return getattr(obj, '_bench_intid', default)
+
+    def getId(self, obj):
+        return obj._bench_intid
+
+    def queryObject(self, doc_id, default=None):
+        return self.refs.get(doc_id, default)
+
+    def getObject(self, doc_id):
+        return self.refs[doc_id]
+
+
+class Fixture(object):
+    """
+    The database, with the wide and deep threads.
+    """
+
+    def __init__(self):
+        xmlconfig.file('configure.zcml', package=nti.threadable)
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open()
+        root = self.conn.root()
+        self.intids = root['intids'] = IntIds()
+        component.getGlobalSiteManager().registerUtility(self.intids, IIntIds)
+
+        self.clock = 0
+        self.wide = root['wide'] = self.add(None)
+        for i in range(WIDTH):
+            self.add(self.wide)
+            if i % 1000 == 0:
+                transaction.commit()
+
+        self.deep = root['deep'] = self.add(None)
+        leaf = self.deep
+        for _ in range(DEPTH):
+            leaf = self.add(leaf)
+        # The references a client would send. (Only for the leaf, so
+        # that building the thread isn't quadratic.)
+        ancestor = leaf.inReplyTo
+        while ancestor is not None:
+            leaf.addReference(ancestor)
+            ancestor = ancestor.inReplyTo
+        self.leaf = root['leaf'] = leaf
+        transaction.commit()
+
+    def add(self, parent):
+        self.clock += 1
+        post = Post()
+        post.createdTime = self.clock
+        self.conn.add(post)
+        self.intids.register(post)
+        post.inReplyTo = parent
+        threadable_added(post, None)
+        return post
+
+    def remove(self, post):
+        threadable_removed(post, None)
+        self.intids.unregister(post)
+
+
+_fixture = None
+
+
+def get_fixture():
+    global _fixture  # pylint: disable=global-statement
+    if _fixture is None:
+        _fixture = Fixture()
+    return _fixture
+
+
+class Op(object):
+    """
+    An operation to measure. *run* is called with the fixture and
+    the result of *before*; *after* cleans up. Neither of those is
+    measured, and each run starts with an empty object cache.
+    """
+
+    def __init__(self, name, run, before=None, after=None):
+        self.name = name
+        self.run = run
+        self.before = before
+        self.after = after
+
+    def prepare(self, fixture):
+        state = self.before(fixture) if self.before is not None else None
+        fixture.conn.cacheMinimize()
+        return state
+
+    def finish(self, fixture, state):
+        if self.after is not None:
+            self.after(fixture, state)
+
+    def time(self, fixture):
+        state = self.prepare(fixture)
+        begin = default_timer()
+        self.run(fixture, state)
+        elapsed = default_timer() - begin
+        self.finish(fixture, state)
+        return elapsed
+
+
+def _add_reply(parent_name):
+    def run(fixture, unused_state):
+        reply = fixture.add(getattr(fixture, parent_name))
+        transaction.commit()
+        fixture.last = reply
+
+    def after(fixture, unused_state):
+        fixture.remove(fixture.last)
+        transaction.commit()
+    return run, None, after
+
+
+def _remove_reply(parent_name):
+    def before(fixture):
+        reply = fixture.add(getattr(fixture, parent_name))
+        transaction.commit()
+        return reply
+
+    def run(fixture, reply):
+        fixture.remove(reply)
+        transaction.commit()
+    return run, before, None
+
+
+def _read(read):
+    def run(fixture, unused_state):
+        read(fixture)
+    return run, None, None
+
+
+def _created_times(objects):
+    # The intid utility hands back ghosts; touch an attribute of each
+    # so that it is actually loaded.
+    return [x.createdTime for x in objects]
+
+
+OPS = (
+    Op('threadable_added (wide)', *_add_reply('wide')),
+    Op('threadable_added (deep)', *_add_reply('leaf')),
+    Op('threadable_removed (wide)', *_remove_reply('wide')),
+    Op('threadable_removed (deep)', *_remove_reply('leaf')),
+    Op('replies (wide)', *_read(lambda f: _created_times(f.wide.replies))),
+    Op('referents (wide)', *_read(lambda f: _created_times(f.wide.referents))),
+    Op('referents (deep)', *_read(lambda f: _created_times(f.deep.referents))),
+    Op('most_recent_reply (wide)', *_read(lambda f: f.wide.most_recent_reply.createdTime)),
+    Op('replyCount (wide)', *_read(lambda f: f.wide.replyCount)),
+    Op('toExternalObject (deep leaf)',
+       *_read(lambda f: PostIO(f.leaf).toExternalObject())),
+)
+
+
+def time_op(loops, op):
+    fixture = get_fixture()
+    return sum(op.time(fixture) for _ in range(loops))
+
+
+def _written_bytes(db, since):
+    return sum(len(record.data or b'')
+               for txn in db.storage.iterator()
+               if txn.tid > since
+               for record in txn)
+
+
+def print_counts():
+    fixture = get_fixture()
+    conn, db = fixture.conn, fixture.db
+    print('%-30s %10s %10s %14s' % ('operation', 'loads', 'stores', 'bytes written'))
+    for op in OPS:
+        state = op.prepare(fixture)
+        since = db.lastTransaction()
+        conn.getTransferCounts(True)
+        op.run(fixture, state)
+        loads, stores = conn.getTransferCounts(True)
+        written = _written_bytes(db, since)
+        op.finish(fixture, state)
+        print('%-30s %10d %10d %14d' % (op.name, loads, stores, written))
+
+
+def main():
+    runner = pyperf.Runner()
+    runner.argparser.add_argument('--counts', action='store_true',
+                                  help="Report object loads and pickle sizes "
+                                       "instead of timings.")
+    args = runner.parse_args()
+    if args.counts:
+        print_counts()
+        return
+    for op in OPS:
+        runner.bench_time_func(op.name, time_op, op)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,8 @@ entry_points = {
 TESTS_REQUIRE = [
     'fudge',
     'nti.testing',
+    'numpy',
+    'zope.catalog',
     'zope.dottedname',
     'zope.testrunner',
 ]
@@ -53,12 +55,14 @@ setup(
     tests_require=TESTS_REQUIRE,
     install_requires=[
         'setuptools',
+        'BTrees',
         'nti.containers',
         'nti.ntiids',
         'nti.externalization',
         'nti.schema',
         'nti.wref',
         'persistent',
+        'transaction >= 2.1.0',
         'zope.component',
         'zope.intid',
         'zope.interface',
@@ -66,6 +70,17 @@ setup(
     ],
     extras_require={
         'test': TESTS_REQUIRE,
+        'catalog': [
+            'zope.catalog',
+        ],
+        'snapshot': [
+            'numpy',
+        ],
+        'benchmarks': [
+            'pyperf',
+            'ZODB',
+            'zope.configuration',
+        ],
         'docs': [
             'Sphinx',
             'repoze.sphinx.autointerface',
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Small, thread-safe, bounded caches.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+
+from collections import OrderedDict
+
+logger = __import__('logging').getLogger(__name__)
+
+_marker = object()
+
+
+class LRUCache(object):
+    """
+    A mapping of at most *maxsize* entries that discards the least
+    recently used entry when full. It counts its hits and misses.
+    """
+
+    def __init__(self, maxsize=1000):
+        if maxsize < 1:
+            raise ValueError("maxsize must be positive", maxsize)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, _marker)
+            if value is _marker:
+                self.misses += 1
+                return default
+            self._data[key] = value  # Now the most recent
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __repr__(self):
+        return '<%s size=%s/%s hits=%s misses=%s>' % (self.__class__.__name__,
+                                                       len(self), self.maxsize,
+                                                       self.hits, self.misses)
+
+
+class AncestorChainCache(object):
+    """
+    A per-process cache of the intids of the ancestors of threadables,
+    nearest first, by the intid of the threadable.
+
+    Each entry remembers the oid and serial (``_p_oid`` and
+    ``_p_serial``) of the threadable it was computed for, and is only
+    used for that object in that state. Any committed change to the
+    threadable, in any process, and any reuse of its intid, makes the
+    entry stale. Objects without an oid are not cached.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._entries = LRUCache(maxsize)
+
+    @staticmethod
+    def _version(obj):
+        return getattr(obj, '_p_oid', None), getattr(obj, '_p_serial', None)
+
+    def get(self, intid, obj):
+        entry = self._entries.get(intid)
+        if entry is None:
+            return None
+        version, chain = entry
+        if version != self._version(obj):
+            self._entries.pop(intid)
+            return None
+        return chain
+
+    def set(self, intid, obj, chain):
+        version = self._version(obj)
+        if version[0] is not None:
+            self._entries.set(intid, (version, tuple(chain)))
+
+    def invalidate(self, intid):
+        self._entries.pop(intid)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hits(self):
+        return self._entries.hits
+
+    @property
+    def misses(self):
+        return self._entries.misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self._entries)
+
+#: The cache used by the subscribers
+ancestor_chain_cache = AncestorChainCache()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Catalog indexes of the thread information of threadables.
+
+These require :mod:`zope.catalog` (the ``catalog`` extra). With them
+installed in a catalog, questions such as "the replies in these
+threads" are answered by intersecting the index sets, without loading
+any threadable.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import BTrees
+
+from zope import component
+from zope import interface
+
+from zope.catalog.field import FieldIndex
+
+from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import IThreadMembership
+
+logger = __import__('logging').getLogger(__name__)
+
+IX_THREAD_ROOT = 'threadRootId'
+IX_IN_REPLY_TO = 'inReplyToId'
+IX_THREAD_DEPTH = 'threadDepth'
+IX_IS_CHILD = 'isOrWasChildInThread'
+
+
+@component.adapter(IThreadable)
+@interface.implementer(IThreadMembership)
+class ThreadMembership(object):
+    """
+    Adapts a threadable for indexing. Values that are unknown are
+    None, so the threadable is left out of that index.
+    """
+
+    __slots__ = ('context',)
+
+    def __init__(self, context):
+        self.context = context
+
+    @property
+    def threadRootId(self):
+        return getattr(self.context, 'threadRootId', None)
+
+    @property
+    def inReplyToId(self):
+        return getattr(self.context, 'inReplyToId', None)
+
+    @property
+    def threadDepth(self):
+        return getattr(self.context, 'threadDepth', None)
+
+    @property
+    def isOrWasChildInThread(self):
+        is_child = getattr(self.context, 'isOrWasChildInThread', None)
+        if is_child is not None:
+            return bool(is_child())
+        return self.context.inReplyTo is not None
+
+
+class ThreadRootIdIndex(FieldIndex):
+    default_field_name = IX_THREAD_ROOT
+    default_interface = IThreadMembership
+
+
+class InReplyToIdIndex(FieldIndex):
+    default_field_name = IX_IN_REPLY_TO
+    default_interface = IThreadMembership
+
+
+class ThreadDepthIndex(FieldIndex):
+    default_field_name = IX_THREAD_DEPTH
+    default_interface = IThreadMembership
+
+
+class IsOrWasChildInThreadIndex(FieldIndex):
+    default_field_name = IX_IS_CHILD
+    default_interface = IThreadMembership
+
+
+_INDEXES = (
+    (IX_THREAD_ROOT, ThreadRootIdIndex),
+    (IX_IN_REPLY_TO, InReplyToIdIndex),
+    (IX_THREAD_DEPTH, ThreadDepthIndex),
+    (IX_IS_CHILD, IsOrWasChildInThreadIndex),
+)
+
+
+def install_thread_indexes(catalog, family=BTrees.family64):
+    """
+    Add the thread indexes that *catalog* does not already have.
+
+    :return: The names of the indexes that were added.
+    """
+    added = []
+    for name, factory in _INDEXES:
+        if name not in catalog:
+            catalog[name] = factory(family=family)
+            added.append(name)
+    return added
+
+
+def _any_of(index, values):
+    return index.family.IF.multiunion([index.apply((value, value))
+                                       for value in values])
+
+
+def query_thread_members(catalog, root_ids=None, parent_ids=None,
+                         min_depth=None, max_depth=None, top_level=None):
+    """
+    Find the intids of the cataloged threadables that match all of the
+    given criteria.
+
+    :keyword root_ids: The threadables in any of these threads
+        (including their roots).
+    :keyword parent_ids: The direct replies to any of these.
+    :keyword int min_depth: The threadables at least this deep
+        (roots are at depth 0).
+    :keyword int max_depth: The threadables at most this deep.
+    :keyword bool top_level: If true, the threadables that are not,
+        and never were, replies; if false, those that are or were.
+    :return: A set of intids, or None if no criteria were given.
+    """
+    results = []
+    if root_ids is not None:
+        results.append(_any_of(catalog[IX_THREAD_ROOT], root_ids))
+    if parent_ids is not None:
+        results.append(_any_of(catalog[IX_IN_REPLY_TO], parent_ids))
+    if min_depth is not None or max_depth is not None:
+        results.append(catalog[IX_THREAD_DEPTH].apply((min_depth, max_depth)))
+    if top_level is not None:
+        is_child = not top_level
+        results.append(catalog[IX_IS_CHILD].apply((is_child, is_child)))
+    if not results:
+        return None
+
+    # Smallest first, so that the intersections stay small
+    results.sort(key=len)
+    family = catalog[IX_THREAD_ROOT].family
+    result = results[0]
+    for other in results[1:]:
+        if not result:
+            break
+        result = family.IF.intersection(result, other)
+    return result
+
+
+def thread_root_ids(catalog, doc_ids):
+    """
+    The intids of the roots of the threads that the threadables with
+    intids *doc_ids* are in. This uses only the index.
+
+    For example, given the intids of everything created since some
+    time (from a time index), this finds the threads with activity
+    since then.
+    """
+    # pylint: disable=protected-access
+    index = catalog[IX_THREAD_ROOT]
+    documents = index._rev_index
+    roots = index.family.IF.TreeSet()
+    for doc_id in doc_ids:
+        root_id = documents.get(doc_id)
+        if root_id is not None:
+            roots.add(root_id)
+    return roots
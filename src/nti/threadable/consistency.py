@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Finding, and optionally repairing, replies and referents that don't
+match the ``inReplyTo`` pointers of the threadables.
+
+They can drift apart if a subscriber failed part way through, or if
+events were suppressed (for example, during a migration). The
+``inReplyTo`` pointers are taken as the truth: the replies of a
+threadable should be exactly the threadables that point to it, and
+its referents exactly those below it.
+
+Each threadable is checked from both sides. Its parent and ancestors
+must have it in their replies and referents (otherwise it is
+*missing* from them), and everything in its own replies and referents
+must actually be below it (otherwise it is *extra*). This only needs
+the ancestors of each threadable, so the threadables (and the
+members of each set) can be checked in batches, with memory bounded
+by the size of a batch.
+
+If a :class:`.IReferentQueue` is in use, drain it first; otherwise
+the referents it has yet to add are reported as missing.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+from itertools import islice
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.threadable.interfaces import IThreadable
+
+from nti.threadable.migration import _Checkpointer
+from nti.threadable.migration import _ancestor_ids
+
+from nti.threadable.subscribers import _add_replies
+from nti.threadable.subscribers import _add_referents
+from nti.threadable.subscribers import _remove_replies
+from nti.threadable.subscribers import _remove_referents
+
+from nti.threadable.threadable import _threadables
+from nti.threadable.threadable import _created_time
+
+logger = __import__('logging').getLogger(__name__)
+
+REPLIES = 'replies'
+REFERENTS = 'referents'
+
+# The set, its count and its time index for each name
+_ATTRIBUTES = {
+    REPLIES: ('_replies', '_reply_count', '_replies_by_time'),
+    REFERENTS: ('_referents', '_referent_count', '_referents_by_time'),
+}
+
+
+class ThreadInconsistency(object):
+    """
+    The differences between the replies (or referents) of one
+    threadable and what they should be.
+    """
+
+    __slots__ = ('intid', 'name', 'missing', 'extra', 'countDrift')
+
+    def __init__(self, intid, name, missing=(), extra=(), countDrift=0):
+        #: The intid of the threadable
+        self.intid = intid
+        #: Either :data:`REPLIES` or :data:`REFERENTS`
+        self.name = name
+        #: The intids that should be in the set but are not
+        self.missing = missing
+        #: The intids that are in the set but should not be
+        self.extra = extra
+        #: How much the maintained count (``replyCount`` or
+        #: ``referentCount``) exceeds the size of the set
+        self.countDrift = countDrift
+
+    def __repr__(self):
+        return '<%s %s %s missing=%s extra=%s countDrift=%s>' % (
+            self.__class__.__name__, self.intid, self.name,
+            list(self.missing), list(self.extra), self.countDrift)
+
+
+class _Differences(object):
+    """
+    The differences found in one batch, by ``(intid, name)``.
+    """
+
+    def __init__(self):
+        # intid -> (createdTime, intid) of the missing threadables
+        self.missing = defaultdict(dict)
+        # intid -> createdTime (or None if unknown) of the extra ones
+        self.extra = defaultdict(dict)
+        self.drift = {}
+
+    def inconsistencies(self):
+        for target in sorted(set(self.missing).union(self.extra, self.drift)):
+            yield target, ThreadInconsistency(target[0], target[1],
+                                              tuple(sorted(self.missing.get(target, ()))),
+                                              tuple(sorted(self.extra.get(target, ()))),
+                                              self.drift.get(target, 0))
+
+
+def _gc(obj):
+    jar = getattr(obj, '_p_jar', None)
+    if jar is not None:
+        jar.cacheGC()
+
+
+def _check_ancestors(obj, doc_id, intids, chains, differences):
+    # Is obj in the replies of its parent and the referents of all
+    # its ancestors?
+    chain = _ancestor_ids(obj, doc_id, intids, chains)
+    if not chain:
+        return  # A root, or unknown
+    key = (_created_time(obj), doc_id)
+    for name, ancestor_id in [(REPLIES, chain[0])] + [(REFERENTS, x) for x in chain]:
+        ancestor = intids.queryObject(ancestor_id)
+        if doc_id not in getattr(ancestor, _ATTRIBUTES[name][0], ()):
+            differences.missing[(ancestor_id, name)][doc_id] = key
+
+
+def _check_members(obj, doc_id, intids, chains, differences,
+                   batch_size, max_cached_chains):
+    # Is everything in the replies and referents of obj actually
+    # below it? The referents of a root are its whole thread, so
+    # they are checked in batches too, letting the members already
+    # checked be released.
+    for name, (set_name, count_name, _) in _ATTRIBUTES.items():
+        members = getattr(obj, set_name, ())
+        for count, member_id in enumerate(members, 1):
+            if count % batch_size == 0:
+                _gc(obj)
+                if len(chains) > max_cached_chains:
+                    chains.clear()
+            member = intids.queryObject(member_id)
+            if not IThreadable.providedBy(member):
+                # Gone; we don't know when it was created
+                differences.extra[(doc_id, name)][member_id] = None
+                continue
+            chain = _ancestor_ids(member, member_id, intids, chains)
+            if chain is None:
+                continue  # Can't tell, so leave it alone
+            below = chain[:1] == (doc_id,) if name == REPLIES else doc_id in chain
+            if not below:
+                differences.extra[(doc_id, name)][member_id] = _created_time(member)
+        counter = getattr(obj, count_name, None)
+        if counter is not None and counter() != len(members):
+            differences.drift[(doc_id, name)] = counter() - len(members)
+
+
+def _extra_keys(threadable, name, extra):
+    # The (createdTime, intid) keys to remove. For those whose time we
+    # don't know, look in the time index.
+    keys = [(created or 0, doc_id) for doc_id, created in extra.items()]
+    unknown = set(doc_id for doc_id, created in extra.items() if created is None)
+    index = getattr(threadable, _ATTRIBUTES[name][2], None)
+    if unknown and index:
+        keys.extend(key for key in index if key[1] in unknown)
+    return sorted(keys)
+
+
+def _repair(threadable, name, intids, differences, target):
+    # pylint: disable=protected-access
+    set_name, count_name, _ = _ATTRIBUTES[name]
+    extra = _extra_keys(threadable, name, differences.extra.get(target, {}))
+    missing = sorted(differences.missing.get(target, {}).values())
+    if name == REPLIES:
+        if extra:
+            _remove_replies(threadable, intids, extra)
+        if missing:
+            _add_replies(threadable, intids, missing)
+    else:
+        if extra:
+            _remove_referents(threadable, extra)
+        if missing:
+            _add_referents(threadable, intids, missing)
+    # The helpers adjust the count by what they changed; if it had
+    # already drifted, start it over.
+    counter = getattr(threadable, count_name, None)
+    size = len(getattr(threadable, set_name, ()))
+    if counter is not None and counter() != size:
+        counter.set(size)
+
+
+def find_thread_inconsistencies(objects=None, intids=None, repair=False,
+                                batch_size=1000, max_cached_chains=100000,
+                                savepoint_every=None, commit_every=None):
+    """
+    Check the replies and referents of the threadables in *objects*
+    (and of their ancestors) against their ``inReplyTo`` pointers,
+    generating a :class:`ThreadInconsistency` for each set that
+    differs.
+
+    This is a generator; nothing is checked until it is iterated.
+    The inconsistencies found in each batch are generated once it has
+    been checked (and, if requested, repaired), so the differences of
+    one set may be spread over more than one inconsistency.
+
+    :param objects: An iterable of threadables. Other objects, and
+        objects without intids, are ignored. If not given, every
+        threadable registered with *intids* is checked.
+    :keyword intids: The intid utility. If not given, the current utility
+        is used.
+    :keyword bool repair: If true, each set that differs is fixed (and
+        its count reset) using the same bookkeeping as the subscribers.
+        Sets that don't differ aren't touched.
+    :keyword int batch_size: How many threadables to check at a time,
+        and how many of the replies or referents of one threadable.
+    :keyword int max_cached_chains: How many ancestor chains to remember
+        before starting over; this bounds the memory used.
+    :keyword int savepoint_every: When repairing, make an (optimistic)
+        savepoint after this many threadables are repaired.
+    :keyword int commit_every: When repairing, commit the transaction
+        after this many threadables are repaired.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    checkpointer = _Checkpointer(savepoint_every, commit_every)
+    chains = {}
+    threadables = _threadables(objects, intids)
+    while True:
+        batch = list(islice(threadables, batch_size))
+        if not batch:
+            break
+        differences = _Differences()
+        for doc_id, obj in batch:
+            if len(chains) > max_cached_chains:
+                chains.clear()
+            _check_ancestors(obj, doc_id, intids, chains, differences)
+            _check_members(obj, doc_id, intids, chains, differences,
+                           batch_size, max_cached_chains)
+
+        for target, inconsistency in differences.inconsistencies():
+            if repair:
+                threadable = intids.queryObject(inconsistency.intid)
+                if IThreadable.providedBy(threadable):
+                    _repair(threadable, inconsistency.name, intids,
+                            differences, target)
+                    checkpointer.wrote(threadable)
+            yield inconsistency
+        _gc(batch[-1][1])
+
+
+def repair_thread_inconsistencies(objects=None, intids=None, **kwargs):
+    """
+    Repair the replies and referents of the threadables in *objects*;
+    see :func:`find_thread_inconsistencies`.
+
+    :return: The number of inconsistencies repaired.
+    """
+    count = 0
+    for inconsistency in find_thread_inconsistencies(objects, intids,
+                                                     repair=True, **kwargs):
+        logger.info("Repairing %s", inconsistency)
+        count += 1
+    return count
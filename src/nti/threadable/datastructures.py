@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent helper structures used to maintain thread information.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import heapq
+
+import BTrees
+
+from persistent import Persistent
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class MostRecentReply(Persistent):
+    """
+    Records the intid and creation time of the newest direct reply
+    to a threadable.
+
+    This is kept as its own persistent object, rather than as attributes
+    of the threadable, so that adding replies does not write the parent
+    object. Concurrent updates resolve in favor of the newer reply.
+    """
+
+    intid = None
+    createdTime = 0
+
+    def __init__(self, intid=None, createdTime=0):
+        super(MostRecentReply, self).__init__()
+        self.update(intid, createdTime)
+
+    def update(self, intid, createdTime):
+        self.intid = intid
+        self.createdTime = createdTime or 0
+
+    def _p_resolveConflict(self, unused_old_state, saved_state, new_state):
+        saved_time = (saved_state or {}).get('createdTime', 0)
+        new_time = (new_state or {}).get('createdTime', 0)
+        return new_state if new_time >= saved_time else saved_state
+
+    def __repr__(self):
+        return '<%s %s at %s>' % (self.__class__.__name__,
+                                  self.intid, self.createdTime)
+
+
+class ShardedTreeSet(Persistent):
+    """
+    A set of integers (intids) spread across several ``TreeSet``
+    shards, chosen by the value modulo the number of shards.
+
+    Concurrent transactions adding different values usually write
+    different shards, so they conflict far less often than they do
+    when they all write the buckets of a single set. Once created, this
+    object itself is never changed.
+
+    It supports the parts of the ``TreeSet`` API the subscribers use;
+    iteration is in sorted order, like a ``TreeSet``.
+    """
+
+    def __init__(self, shards=8, family=BTrees.family64):
+        super(ShardedTreeSet, self).__init__()
+        if shards < 1:
+            raise ValueError("shards must be positive", shards)
+        self._shards = tuple(family.II.TreeSet() for _ in range(shards))
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def _shard(self, value):
+        return self._shards[value % len(self._shards)]
+
+    def add(self, value):
+        return self._shard(value).add(value)
+    insert = add
+
+    def remove(self, value):
+        self._shard(value).remove(value)
+
+    def update(self, values):
+        """
+        Add all of *values*, returning how many were not already present.
+        """
+        by_shard = {}
+        for value in values:
+            by_shard.setdefault(value % len(self._shards), []).append(value)
+        return sum(self._shards[index].update(group)
+                   for index, group in by_shard.items())
+
+    def __contains__(self, value):
+        return value in self._shard(value)
+    has_key = __contains__
+
+    def __iter__(self):
+        return heapq.merge(*self._shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+    def __bool__(self):
+        return any(self._shards)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<%s shards=%s>' % (self.__class__.__name__, len(self._shards))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Deferring the propagation of referents to the ancestors of a
+threadable.
+
+Registering a :class:`ReferentQueue` as the :class:`.IReferentQueue`
+utility makes the subscribers only update the replies of the direct
+parent of an added or removed threadable; the change to the referents
+of all its ancestors is queued instead. This keeps the cost of adding a
+reply independent of the depth of its thread and keeps the ancestors
+out of the transaction that adds it. Until the queue is drained, the
+referents (and ``referentCount``) of the ancestors lag behind.
+
+A background worker should call :func:`process_referent_queue`;
+tests can call :func:`flush_referent_queue`.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import random
+
+from collections import defaultdict
+
+import BTrees
+
+from BTrees.Length import Length
+
+import transaction
+
+from persistent import Persistent
+
+from zope import component
+from zope import interface
+
+from zope.intid.interfaces import IIntIds
+
+from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import IReferentQueue
+
+from nti.threadable.subscribers import _add_referents
+from nti.threadable.subscribers import _remove_referents
+
+logger = __import__('logging').getLogger(__name__)
+
+
+@interface.implementer(IReferentQueue)
+class ReferentQueue(Persistent):
+    """
+    A persistent :class:`.IReferentQueue`.
+
+    Entries are kept in a BTree in the order they were added, keyed
+    by a sequence number that only ever goes up (rather than the time,
+    which can go back, or differ between processes). Concurrent
+    transactions can be given the same number, so each key also has a
+    random part to keep them from adding the same key.
+    """
+
+    def __init__(self, family=BTrees.family64):
+        super(ReferentQueue, self).__init__()
+        self._entries = family.OO.BTree()
+        self._length = Length()
+        self._sequence = Length()
+
+    def _put(self, added, keys, ancestor_ids):
+        self._sequence.change(1)
+        key = (self._sequence(), random.randint(0, 2 ** 62))
+        self._entries[key] = (added, tuple(keys), tuple(ancestor_ids))
+        self._length.change(1)
+
+    def added(self, keys, ancestor_ids):
+        self._put(True, keys, ancestor_ids)
+
+    def removed(self, keys, ancestor_ids):
+        self._put(False, keys, ancestor_ids)
+
+    def take(self, limit=None):
+        keys = self._entries.keys()
+        keys = list(keys[:limit] if limit is not None else keys)
+        if not keys:
+            return []
+        self._length.change(-len(keys))
+        return [self._entries.pop(key) for key in keys]
+
+    def __len__(self):
+        return self._length()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, len(self))
+
+
+def drain_referent_queue(queue=None, intids=None, limit=None):
+    """
+    Take (at most *limit*) entries from the queue and update the
+    referents of their ancestors, each ancestor being written once.
+
+    :return: The number of entries taken.
+    """
+    queue = component.getUtility(IReferentQueue) if queue is None else queue
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    entries = queue.take(limit)
+
+    # The last thing that happened to each intid below each ancestor
+    changes = defaultdict(dict)
+    for added, keys, ancestor_ids in entries:
+        for ancestor_id in ancestor_ids:
+            pending = changes[ancestor_id]
+            for key in keys:
+                pending[key[1]] = (added, key)
+
+    for ancestor_id, pending in changes.items():
+        ancestor = intids.queryObject(ancestor_id)
+        if not IThreadable.providedBy(ancestor):
+            continue
+        removed = sorted(key for added, key in pending.values() if not added)
+        if removed:
+            _remove_referents(ancestor, removed)
+        # Intids aren't reused, so one that no longer resolves was
+        # removed, whatever order its entries are in.
+        added = sorted(key for added, key in pending.values()
+                       if added and intids.queryObject(key[1]) is not None)
+        if added:
+            _add_referents(ancestor, intids, added)
+    return len(entries)
+
+
+def flush_referent_queue(queue=None, intids=None):
+    """
+    Drain the whole queue in the current transaction.
+    """
+    return drain_referent_queue(queue, intids)
+
+
+def process_referent_queue(queue=None, intids=None, batch_size=100,
+                           transaction_manager=None, attempts=3):
+    """
+    Drain the queue in batches of *batch_size* entries, committing
+    each batch in its own transaction (retried up to *attempts* times
+    if it conflicts), until it is empty.
+
+    :return: The number of entries processed.
+    """
+    tm = transaction.manager if transaction_manager is None else transaction_manager
+    total = 0
+    while True:
+        for attempt in tm.attempts(attempts):
+            with attempt:
+                count = drain_referent_queue(queue, intids, batch_size)
+        total += count
+        if count < batch_size:
+            return total
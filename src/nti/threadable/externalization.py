@@ -8,14 +8,231 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import threading
 import collections
 
+from contextlib import contextmanager
+
+import transaction
+
+from transaction import interfaces as txn_interfaces
+
+from nti.externalization.externalization import to_external_object
+
 from nti.ntiids.oids import to_external_ntiid_oid
 
+from nti.threadable.cache import LRUCache
+
+from nti.threadable.threadable import ThreadableMixin
+
 from nti.wref.interfaces import IWeakRefToMissing
 
 logger = __import__('logging').getLogger(__name__)
 
+# Raised by transaction.get() when an explicit transaction manager has
+# no transaction in progress (older versions of transaction don't have it)
+_NoTransaction = getattr(txn_interfaces, 'NoTransaction', ())
+
+#: Per-thread state; see :func:`external_reference_memo`
+_local = threading.local()
+
+
+def _memo_key(obj):
+    # Persistent objects are identified by their connection and oid,
+    # which does not require activating them. Others aren't memoized.
+    oid = getattr(obj, '_p_oid', None)
+    if oid is None:
+        return None
+    return id(getattr(obj, '_p_jar', None)), oid
+
+
+def _ref_memo_key(ref):
+    # The same, for the target of a weak reference that knows the oid
+    # it refers to (as persistent.wref.WeakRef does), without resolving it.
+    oid = getattr(ref, 'oid', None)
+    if oid is None:
+        return None
+    return id(getattr(ref, 'dm', None)), oid
+
+
+@contextmanager
+def external_reference_memo():
+    """
+    A context manager for a rendering pass. Within it, the external
+    NTIID of each object that threadables are replies to, or reference,
+    is computed only once, no matter how many threadables share it.
+
+    Blocks may be nested; the outermost one determines the lifetime
+    of the memo.
+    """
+    memo = getattr(_local, 'memo', None)
+    if memo is not None:
+        yield memo
+        return
+    _local.memo = memo = {}
+    try:
+        yield memo
+    finally:
+        _local.memo = None
+
+
+def _cache_key(obj):
+    # The database name and oid of a persistent object that is
+    # stored in a database. This doesn't activate the object.
+    oid = getattr(obj, '_p_oid', None)
+    jar = getattr(obj, '_p_jar', None)
+    if oid is None or jar is None:
+        return None
+    # Not every jar is a ZODB Connection
+    db = getattr(jar, 'db', None)
+    database_name = getattr(db(), 'database_name', None) if db is not None else None
+    if database_name is None:
+        return None
+    return database_name, oid
+
+
+def _ref_cache_key(ref):
+    oid = getattr(ref, 'oid', None)
+    database_name = getattr(ref, 'database_name', None)
+    if oid is None or database_name is None:
+        return None
+    return database_name, oid
+
+
+class ExternalNTIIDCache(object):
+    """
+    A bounded (LRU) cache of the external NTIIDs of persistent
+    objects, keyed by their database and oid. Objects that
+    aren't stored in a database are not cached.
+
+    By default, entries only live until the end of the current
+    transaction. If *per_transaction* is false, entries are shared
+    between transactions and threads; objects are then expected to be
+    :meth:`invalidated <invalidate>` when they are deleted (the
+    subscribers do this for threadables).
+
+    The :attr:`hits` and :attr:`misses` show how effective the
+    cache is. The cache is only an optimization: objects whose jar
+    isn't a ZODB connection, and (if *per_transaction*) lookups
+    made with no transaction in progress, simply aren't cached.
+    """
+
+    def __init__(self, maxsize=1000, per_transaction=True):
+        self.maxsize = maxsize
+        self.per_transaction = per_transaction
+        self.hits = 0
+        self.misses = 0
+        self._shared = LRUCache(maxsize)
+
+    def _entries(self):
+        # The entries to use, or None if there aren't any
+        if not self.per_transaction:
+            return self._shared
+        try:
+            txn = transaction.get()
+        except _NoTransaction:
+            return None
+        try:
+            return txn.data(self)
+        except KeyError:
+            entries = LRUCache(self.maxsize)
+            txn.set_data(self, entries)
+            return entries
+
+    def get(self, obj):
+        key = _cache_key(obj)
+        if key is None:
+            return None
+        entries = self._entries()
+        result = entries.get(key) if entries is not None else None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def lookup(self, key):
+        """
+        Find the NTIID of an object by its cache key, without
+        needing the object. Only hits are counted; on a miss, the
+        caller is expected to fall back to :meth:`get`.
+        """
+        entries = self._entries()
+        result = entries.get(key) if entries is not None else None
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def set(self, obj, ntiid):
+        key = _cache_key(obj)
+        entries = self._entries() if key is not None else None
+        if entries is not None:
+            entries.set(key, ntiid)
+
+    def invalidate(self, obj):
+        key = _cache_key(obj)
+        entries = self._entries() if key is not None else None
+        if entries is not None:
+            entries.pop(key)
+
+    def clear(self):
+        self._shared.clear()
+        entries = self._entries()
+        if entries is not None:
+            entries.clear()
+        self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '<%s hits=%s misses=%s>' % (self.__class__.__name__,
+                                           self.hits, self.misses)
+
+#: The cache used by default by :class:`ThreadableExternalizableMixin`
+external_ntiid_cache = ExternalNTIIDCache()
+
+
+def external_ntiid(obj, cache=external_ntiid_cache):
+    """
+    The external NTIID of *obj*, or None if it doesn't have one.
+
+    This uses the :func:`external_reference_memo` if there is one,
+    and *cache* (unless it is None).
+    """
+    memo = getattr(_local, 'memo', None)
+    key = _memo_key(obj) if memo is not None else None
+    if key is not None and key in memo:
+        return memo[key]
+    result = cache.get(obj) if cache is not None else None
+    if not result:
+        result = to_external_ntiid_oid(obj)
+        if result and cache is not None:
+            cache.set(obj, result)
+    if result and key is not None:
+        memo[key] = result
+    return result
+
+
+def to_external_threadables(objects, **kwargs):
+    """
+    Externalize each of *objects* (passing *kwargs* to
+    :func:`~nti.externalization.externalization.to_external_object`)
+    in a single :func:`external_reference_memo` and return the list of
+    results.
+    """
+    with external_reference_memo():
+        return [to_external_object(obj, **kwargs) for obj in objects]
+
+
+def _reads_weak_refs(context):
+    # Can the references of context be externalized from its weak
+    # references? Only if it is a ThreadableMixin that reads them
+    # the usual way; otherwise, use its public attributes.
+    if not isinstance(context, ThreadableMixin):
+        return False
+    cls = type(context)
+    return all(getattr(cls, name) == getattr(ThreadableMixin, name)
+               for name in ('inReplyTo', 'getInReplyTo',
+                            'references', 'getReferences'))
+
 
 class ThreadableExternalizableMixin(object):
     """
@@ -39,18 +256,64 @@ class ThreadableExternalizableMixin(object):
     #: See :const:`nti.ntiids.ntiids.TYPE_MISSING`
     _ext_write_missing_references = True
 
+    #: The :class:`ExternalNTIIDCache` used to find the external
+    #: NTIIDs of the objects we reference, or None to not cache them.
+    _ext_ntiid_cache = external_ntiid_cache
+
     def toExternalObject(self, mergeFrom=None, **kwargs):
         extDict = super(ThreadableExternalizableMixin, self).toExternalObject(mergeFrom=mergeFrom, **kwargs)
         if self._ext_can_write_threads():
             assert isinstance(extDict, collections.Mapping)
             context = self._ext_replacement()
             # pylint: disable=protected-access
-            extDict['inReplyTo'] = self._ext_ref(context.inReplyTo, context._inReplyTo)
-            extDict['references'] = [
-                self._ext_ref(ref(), ref) for ref in context._references
-            ]
+            if _reads_weak_refs(context):
+                extDict['inReplyTo'] = self._ext_weak_ref(context._inReplyTo)
+                extDict['references'] = [
+                    self._ext_weak_ref(ref) for ref in context._reference_refs()
+                ]
+            else:
+                extDict['inReplyTo'] = self._ext_ref(context.inReplyTo,
+                                                     getattr(context, '_inReplyTo', None))
+                extDict['references'] = [
+                    self._ext_ref(obj, None) for obj in context.references or ()
+                ]
         return extDict
 
+    def _ext_weak_ref(self, ref):
+        """
+        Produce a string value for the weak reference *ref*.
+
+        This is :meth:`_ext_ref` of the target of *ref*, with one
+        shortcut: if the reference knows the oid of its target and we
+        already know the external NTIID for that oid (from the
+        :func:`external_reference_memo` or the cache), that is used
+        without resolving the reference or activating its target.
+
+        The NTIID can't be computed from the oid alone, so the target
+        is still loaded the first time it is seen. The shortcut is
+        also skipped if a subclass overrides :meth:`_ext_ref`, since
+        its value may not be the NTIID.
+
+        The cache forgets removed threadables (and the memo lasts only
+        for one rendering pass), so a deleted target still produces
+        a missing placeholder.
+        """
+        if ref is None:
+            return self._ext_ref(None, None)
+        if type(self)._ext_ref != ThreadableExternalizableMixin._ext_ref:
+            return self._ext_ref(ref(), ref)
+        memo = getattr(_local, 'memo', None)
+        if memo is not None:
+            key = _ref_memo_key(ref)
+            if key is not None and key in memo:
+                return memo[key]
+        cache = self._ext_ntiid_cache
+        key = _ref_cache_key(ref) if cache is not None else None
+        result = cache.lookup(key) if key is not None else None
+        if result:
+            return result
+        return self._ext_ref(ref(), ref)
+
     def _ext_ref(self, obj, ref):
         """
         Produce a string value for the object we reference (or are a reply to).
@@ -59,7 +322,7 @@ class ThreadableExternalizableMixin(object):
         now referring to an object that is deleted.
         """
         if obj is not None:
-            result = to_external_ntiid_oid(obj)
+            result = external_ntiid(obj, self._ext_ntiid_cache)
             if not result:
                 # pylint: disable=unused-variable
                 __traceback_info__ = self, obj, ref
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Optional instrumentation of the subscribers that maintain threads.
+
+When a recorder is installed with :func:`set_recorder`, each
+``threadable_added`` and ``threadable_removed`` event is timed, and what
+it did is counted in a :class:`Measurement` that is passed to the
+recorder. Without a recorder (the default), the only cost is checking
+for one.
+
+To send the measurements to statsd, install a :class:`StatsdRecorder`.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import threading
+
+from contextlib import contextmanager
+
+from timeit import default_timer
+
+from zope import interface
+
+from nti.threadable.interfaces import IThreadMaintenanceRecorder
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The installed :class:`.IThreadMaintenanceRecorder`, or None
+_recorder = None
+
+#: The measurement of the event being handled by each thread
+_local = threading.local()
+
+
+class Measurement(object):
+    """
+    What handling one event did.
+    """
+
+    __slots__ = ('ancestors', 'weakrefs_resolved', 'intids_resolved',
+                 'sets_created', 'sets_mutated')
+
+    def __init__(self):
+        #: The number of ancestors whose referents were updated
+        self.ancestors = 0
+        #: The number of ``inReplyTo`` weak references resolved
+        #: to find the ancestors
+        self.weakrefs_resolved = 0
+        #: The number of intids resolved to find the ancestors
+        self.intids_resolved = 0
+        #: The number of reply and referent sets created
+        self.sets_created = 0
+        #: The number of existing reply and referent sets changed
+        self.sets_mutated = 0
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            ' '.join('%s=%s' % (name, getattr(self, name))
+                                     for name in self.__slots__))
+
+
+def set_recorder(recorder):
+    """
+    Install *recorder* (or, if None, turn off the instrumentation).
+
+    :return: The previous recorder.
+    """
+    global _recorder  # pylint: disable=global-statement
+    previous, _recorder = _recorder, recorder
+    return previous
+
+
+def get_recorder():
+    return _recorder
+
+
+def current_measurement():
+    """
+    The :class:`Measurement` of the event being handled by this
+    thread, or None if the instrumentation is off.
+    """
+    if _recorder is None:
+        return None
+    return getattr(_local, 'measurement', None)
+
+
+@contextmanager
+def measuring(recorder, kind):
+    """
+    Measure the handling of one event of *kind*, and pass the
+    result to *recorder*.
+    """
+    measurement = _local.measurement = Measurement()
+    begin = default_timer()
+    try:
+        yield measurement
+    finally:
+        duration = default_timer() - begin
+        _local.measurement = None
+        try:
+            recorder.record(kind, duration, measurement)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Failed to record %s", measurement)
+
+
+@interface.implementer(IThreadMaintenanceRecorder)
+class StatsdRecorder(object):
+    """
+    Sends measurements to a statsd client (anything with the
+    ``timing(name, milliseconds)`` and ``incr(name, count)`` methods).
+
+    For each event of a kind, this sends ``<prefix>.<kind>.duration``
+    (in milliseconds) and ``<prefix>.<kind>.ancestors`` as timers, so
+    their distributions are available, and the other counts of the
+    :class:`Measurement` as counters, when they are not zero.
+    """
+
+    def __init__(self, client, prefix='nti.threadable'):
+        self.client = client
+        self.prefix = prefix
+
+    def record(self, kind, duration, measurement):
+        prefix = '%s.%s.' % (self.prefix, kind)
+        self.client.timing(prefix + 'duration', duration * 1000)
+        self.client.timing(prefix + 'ancestors', measurement.ancestors)
+        for name in ('weakrefs_resolved', 'intids_resolved',
+                     'sets_created', 'sets_mutated'):
+            count = getattr(measurement, name)
+            if count:
+                self.client.incr(prefix + name, count)
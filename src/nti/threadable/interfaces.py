@@ -12,6 +12,11 @@ from __future__ import absolute_import
 
 from zope import interface
 
+from zope.interface.interfaces import ObjectEvent
+from zope.interface.interfaces import IObjectEvent
+
+from nti.schema.field import Int
+from nti.schema.field import Bool
 from nti.schema.field import Object
 from nti.schema.field import ListOrTuple
 from nti.schema.field import UniqueIterable
@@ -47,6 +52,50 @@ class IThreadable(interface.Interface):
     referents.setTaggedValue('_ext_excluded_out', True)  # Internal use only
 
 
+class IMaintainedThreadable(IThreadable):
+    """
+    A threadable whose replies are counted, and whose place in its
+    thread is recorded, by the subscribers in
+    :mod:`nti.threadable.subscribers`.
+
+    These are kept apart from :class:`IThreadable` so that
+    implementations that don't maintain them still provide it.
+    """
+
+    inReplyToId = Int(title=u"The intid of the object to which this object is directly a reply.",
+                      readonly=True,
+                      required=False)
+    inReplyToId.setTaggedValue('_ext_excluded_out', True)
+
+    threadRootId = Int(title=u"The intid of the root of the thread this object is part of.",
+                       description=u"This property will be automatically maintained.",
+                       readonly=True,
+                       required=False)
+    threadRootId.setTaggedValue('_ext_excluded_out', True)
+
+    threadDepth = Int(title=u"How many replies deep in its thread this object is.",
+                      description=u"This property will be automatically maintained. "
+                                  u"The root of a thread is at depth 0.",
+                      readonly=True,
+                      required=False,
+                      min=0)
+    threadDepth.setTaggedValue('_ext_excluded_out', True)
+
+    replyCount = Int(title=u"The number of direct replies of this object",
+                     description=u"This property will be automatically maintained.",
+                     readonly=True,
+                     required=False,
+                     default=0)
+    replyCount.setTaggedValue('_ext_excluded_out', True)
+
+    referentCount = Int(title=u"The number of direct and indirect replies to this object",
+                        description=u"This property will be automatically maintained.",
+                        readonly=True,
+                        required=False,
+                        default=0)
+    referentCount.setTaggedValue('_ext_excluded_out', True)
+
+
 class IWeakThreadable(IThreadable):
     """
     Just like :class:`IThreadable`, except with the expectation that
@@ -69,3 +118,126 @@ class IInspectableWeakThreadable(IWeakThreadable):
         ever part of a thread chain. If this returns a true value, it
         implies that at some point ``inRelpyTo`` was non-None.
         """
+
+
+class IThreadMembership(interface.Interface):
+    """
+    The place of a threadable in its thread, as it is cataloged.
+
+    Threadables are adapted to this by the indexes in
+    :mod:`nti.threadable.catalog`.
+    """
+
+    threadRootId = Int(title=u"The intid of the root of the thread.",
+                       required=False)
+
+    inReplyToId = Int(title=u"The intid of the direct parent.",
+                      required=False)
+
+    threadDepth = Int(title=u"How many replies deep in the thread this is.",
+                      required=False,
+                      min=0)
+
+    isOrWasChildInThread = Bool(title=u"Whether this is or was a reply to something.",
+                                required=False)
+
+
+class IReferentQueue(interface.Interface):
+    """
+    A utility that, when registered, defers updating the referents
+    of the ancestors of added and removed threadables.
+
+    The subscribers still update the replies of the direct parent
+    immediately; the referents are updated later, when the queue is
+    drained (see :mod:`nti.threadable.deferred`).
+    """
+
+    def added(keys, ancestor_ids):
+        """
+        Note that the threadables identified by the ``(createdTime, intid)``
+        *keys* were added below the ancestors with intids *ancestor_ids*.
+        """
+
+    def removed(keys, ancestor_ids):
+        """
+        Note that the threadables identified by *keys* were removed
+        from below the ancestors with intids *ancestor_ids*.
+        """
+
+    def take(limit=None):
+        """
+        Remove and return (at most *limit* of) the oldest entries, as
+        ``(added, keys, ancestor_ids)`` tuples.
+        """
+
+    def __len__():
+        """
+        The number of entries waiting.
+        """
+
+
+class IThreadMaintenanceRecorder(interface.Interface):
+    """
+    Receives the measurements of the subscribers that maintain
+    threads; see :mod:`nti.threadable.instrumentation`.
+    """
+
+    def record(kind, duration, measurement):
+        """
+        Record the handling of one event.
+
+        :param str kind: ``'added'`` or ``'removed'``.
+        :param float duration: The time taken, in seconds.
+        :param measurement: A
+            :class:`nti.threadable.instrumentation.Measurement`.
+        """
+
+
+class ThreadWalkError(ValueError):
+    """
+    Raised when walking up the ancestors of a threadable has to stop
+    because the thread is broken.
+
+    .. attribute:: start
+
+       The threadable the walk started from.
+
+    .. attribute:: ancestors
+
+       The ancestors (or, when checking a stored chain, their
+       intids) found before stopping, nearest first.
+    """
+
+    def __init__(self, start, ancestors):
+        super(ThreadWalkError, self).__init__(start, len(ancestors))
+        self.start = start
+        self.ancestors = ancestors
+
+
+class ThreadCycleError(ThreadWalkError):
+    """
+    The ``inReplyTo`` chain leads back to an object already visited.
+    """
+
+
+class ThreadTooDeepError(ThreadWalkError):
+    """
+    The ``inReplyTo`` chain is longer than the maximum allowed depth.
+    """
+
+
+class IThreadWalkAbortedEvent(IObjectEvent):
+    """
+    Notified, with the threadable the walk started from, when a walk
+    up its ancestors is stopped.
+    """
+
+    error = interface.Attribute("The ThreadWalkError describing the problem.")
+
+
+@interface.implementer(IThreadWalkAbortedEvent)
+class ThreadWalkAbortedEvent(ObjectEvent):
+
+    def __init__(self, obj, error):
+        super(ThreadWalkAbortedEvent, self).__init__(obj)
+        self.error = error
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Support for (re)building the thread information of many threadables
+at once.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+import transaction
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.threadable import subscribers
+
+from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import ThreadCycleError
+from nti.threadable.interfaces import ThreadTooDeepError
+
+from nti.threadable.subscribers import _add_replies
+from nti.threadable.subscribers import _add_referents
+from nti.threadable.subscribers import _walk_aborted
+
+from nti.threadable.threadable import _created_time
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class _Checkpointer(object):
+    """
+    Counts writes, periodically making savepoints or committing.
+    """
+
+    def __init__(self, savepoint_every=None, commit_every=None):
+        self.savepoint_every = savepoint_every
+        self.commit_every = commit_every
+        self.writes = 0
+
+    def wrote(self, obj):
+        self.writes += 1
+        if self.commit_every and self.writes % self.commit_every == 0:
+            transaction.commit()
+            # Let the (now clean) objects we touched be released
+            jar = getattr(obj, '_p_jar', None)
+            if jar is not None:
+                jar.cacheGC()
+        elif self.savepoint_every and self.writes % self.savepoint_every == 0:
+            transaction.savepoint(optimistic=True)
+
+
+def _ancestor_ids(obj, doc_id, intids, chains):
+    """
+    The intids of the ancestors of *obj*, nearest first, or None
+    if one of them has no intid or they form a cycle (or are too
+    many; see :data:`.MAX_ANCESTOR_DEPTH`). Chains are memoized in *chains*,
+    so each ancestor is resolved only once however many of its
+    descendants we see.
+    """
+    path = []
+    ancestors = []
+    seen = set([doc_id])
+    current, current_id = obj, doc_id
+    while current_id not in chains:
+        parent = current.inReplyTo
+        if not IThreadable.providedBy(parent):
+            chains[current_id] = ()
+            break
+        parent_id = intids.queryId(parent)
+        if parent_id is None:
+            chains[current_id] = None
+            break
+        ancestors.append(parent)
+        if parent_id in seen:
+            error = ThreadCycleError(obj, ancestors)
+        elif len(ancestors) > subscribers.MAX_ANCESTOR_DEPTH:
+            error = ThreadTooDeepError(obj, ancestors)
+        else:
+            seen.add(parent_id)
+            path.append((current_id, parent_id))
+            current, current_id = parent, parent_id
+            continue
+        _walk_aborted(error)
+        if isinstance(error, ThreadTooDeepError):
+            # Only this chain is too long, not those of the ancestors
+            chains[doc_id] = None
+            return None
+        # Everything leading into the cycle is broken
+        chains[current_id] = None
+        break
+
+    for child_id, parent_id in reversed(path):
+        parent_chain = chains[parent_id]
+        chains[child_id] = None if parent_chain is None else (parent_id,) + parent_chain
+    return chains[doc_id]
+
+
+def _thread_state(obj, doc_id, chain):
+    """
+    The ``(name, value)`` pairs of the denormalized thread attributes
+    of *obj*, given its ancestor *chain*.
+    """
+    if chain is None:
+        # Nothing is known about the ancestors
+        return (('_ancestor_ids', None),
+                ('_inReplyToId', getattr(obj, '_inReplyToId', None)),
+                ('_threadRootId', None),
+                ('_threadDepth', None))
+    return (('_ancestor_ids', chain),
+            ('_inReplyToId', chain[0] if chain else getattr(obj, '_inReplyToId', None)),
+            ('_threadRootId', chain[-1] if chain else doc_id),
+            ('_threadDepth', len(chain)))
+
+
+def rebuild_thread_indexes(objects, intids=None,
+                           savepoint_every=None, commit_every=None):
+    """
+    The bulk equivalent of :func:`.subscribers._do_threadable_added`
+    for each of *objects*: record each object as a reply of its parent
+    and a referent of all its ancestors, and store its ancestor chain,
+    thread root and depth.
+
+    Rather than walking to the root for each object, the ancestor
+    chains are computed once (and shared between siblings), the replies
+    and referents of each ancestor are gathered in memory, and then each
+    ancestor is written exactly once with a bulk ``update``. As with the
+    subscribers, this only adds; existing entries are kept.
+
+    :param objects: An iterable of threadables. Other objects, and
+        objects without intids, are ignored.
+    :keyword intids: The intid utility. If not given, the current utility
+        is used.
+    :keyword int savepoint_every: If given, make an (optimistic)
+        savepoint after this many objects are written.
+    :keyword int commit_every: If given, commit the transaction after
+        this many objects are written, allowing the object cache to be
+        garbage collected. Use this to rebuild more objects than fit
+        in the cache.
+    :return: The number of objects that were written.
+    """
+    # pylint: disable=protected-access
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    checkpointer = _Checkpointer(savepoint_every, commit_every)
+    chains = {}
+    replies = defaultdict(list)
+    referents = defaultdict(list)
+
+    for obj in objects:
+        if not IThreadable.providedBy(obj):
+            continue
+        doc_id = intids.queryId(obj)
+        if doc_id is None:
+            continue
+        chain = _ancestor_ids(obj, doc_id, intids, chains)
+        state = _thread_state(obj, doc_id, chain)
+        if any(getattr(obj, name, None) != value for name, value in state):
+            for name, value in state:
+                setattr(obj, name, value)
+            checkpointer.wrote(obj)
+        if not chain:
+            continue
+        key = (_created_time(obj), doc_id)
+        replies[chain[0]].append(key)
+        for ancestor_id in chain:
+            referents[ancestor_id].append(key)
+
+    # Now we only need the ancestors themselves
+    chains = None
+    for ancestor_id in set(replies).union(referents):
+        ancestor = intids.queryObject(ancestor_id)
+        if not IThreadable.providedBy(ancestor):
+            continue
+        if ancestor_id in replies:
+            _add_replies(ancestor, intids, sorted(replies.pop(ancestor_id)))
+        if ancestor_id in referents:
+            _add_referents(ancestor, intids, sorted(referents.pop(ancestor_id)))
+        checkpointer.wrote(ancestor)
+    return checkpointer.writes
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Exporting the structure of threads to a snapshot on disk, and loading
+it back.
+
+A snapshot is a directory of NumPy ``.npy`` files, one for each of
+:data:`COLUMNS`, with a row for each threadable. The files are written
+while the threadables are walked, one chunk of rows at a time, and are
+memory-mapped when loaded, so a process can find the replies of any
+threadable in a site (for example, to warm its caches at start up)
+without loading a single threadable. Values that are not known are
+stored as :data:`MISSING`.
+
+This requires NumPy (the ``snapshot`` extra).
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+
+import numpy
+
+from numpy.lib import format as npy_format
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.threadable.threadable import _threadables
+from nti.threadable.threadable import _created_time
+
+from nti.threadable.tree import _parent_id
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The value of an intid, root or depth that is not known
+MISSING = -1
+
+#: The ``(name, dtype)`` of each column of a snapshot
+COLUMNS = (
+    ('intid', '<i8'),
+    ('parent', '<i8'),
+    ('root', '<i8'),
+    ('depth', '<i4'),
+    ('created', '<f8'),
+)
+
+
+def _column_path(path, name):
+    return os.path.join(path, name + '.npy')
+
+
+class _ColumnWriter(object):
+    """
+    Appends to a ``.npy`` file whose length isn't known until it is
+    closed. The header is rewritten then; it is padded to a fixed size,
+    so the data doesn't have to move.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.count = 0
+        self._file = open(path, 'wb')
+        self._write_header()
+        self._data_offset = self._file.tell()
+
+    def _write_header(self):
+        header = {
+            'descr': npy_format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.count,),
+        }
+        npy_format.write_array_header_1_0(self._file, header)
+
+    def write(self, values):
+        numpy.asarray(values, dtype=self.dtype).tofile(self._file)
+        self.count += len(values)
+
+    def close(self):
+        self._file.seek(0)
+        self._write_header()
+        offset = self._file.tell()
+        self._file.close()
+        if offset != self._data_offset:  # pragma: no cover
+            raise ValueError("The header of %s changed size" % self.path)
+
+
+def _known(value):
+    return MISSING if value is None else value
+
+
+def export_thread_snapshot(path, objects=None, intids=None,
+                           chunk_size=10000, deactivate=True):
+    """
+    Write a snapshot of the threadables in *objects* to the directory
+    *path* (which is created if needed). The thread information stored
+    on each threadable is used; nothing is walked.
+
+    The files are written under temporary names and only renamed into
+    place once all of them are complete, so an existing snapshot is
+    replaced only by a whole new one.
+
+    :param objects: An iterable of threadables. Other objects, and
+        objects without intids, are ignored. If not given, every
+        threadable registered with *intids* is exported.
+    :keyword intids: The intid utility. If not given, the current utility
+        is used.
+    :keyword int chunk_size: How many rows to hold in memory before
+        writing them out.
+    :keyword bool deactivate: If true (the default), each persistent
+        threadable without unsaved changes is turned back into a ghost
+        once it has been exported, so that walking a whole site doesn't
+        fill the object cache.
+    :return: The number of threadables exported.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    writers = []
+    complete = False
+    try:
+        for name, dtype in COLUMNS:
+            writers.append(_ColumnWriter(_column_path(path, name) + '.tmp', dtype))
+        rows = []
+        for doc_id, obj in _threadables(objects, intids):
+            rows.append((doc_id,
+                         _known(_parent_id(obj, intids)),
+                         _known(getattr(obj, 'threadRootId', None)),
+                         _known(getattr(obj, 'threadDepth', None)),
+                         _created_time(obj)))
+            if deactivate and getattr(obj, '_p_changed', None) is False:
+                obj._p_deactivate()
+            if len(rows) >= chunk_size:
+                for writer, values in zip(writers, zip(*rows)):
+                    writer.write(values)
+                rows = []
+        if rows:
+            for writer, values in zip(writers, zip(*rows)):
+                writer.write(values)
+        complete = True
+    finally:
+        for writer in writers:
+            writer.close()
+            if not complete:
+                os.remove(writer.path)
+
+    for writer, (name, _) in zip(writers, COLUMNS):
+        os.rename(writer.path, _column_path(path, name))
+    count = writers[0].count
+    logger.info("Exported %s threadables to %s", count, path)
+    return count
+
+
+class ThreadSnapshot(object):
+    """
+    The columns of a snapshot, with the relations between its rows.
+
+    Each column is an array (one of :data:`COLUMNS`) with an element
+    for each threadable, in the order they were exported. The
+    indexes needed to find the parent and replies of a row are
+    computed, with NumPy, the first time they are needed.
+    """
+
+    def __init__(self, intid, parent, root, depth, created):
+        lengths = set(len(x) for x in (intid, parent, root, depth, created))
+        if len(lengths) > 1:
+            raise ValueError("Columns of different lengths", lengths)
+        self.intid = intid
+        self.parent = parent
+        self.root = root
+        self.depth = depth
+        self.created = created
+        self._sorted_ids = None
+        self._parent_rows = None
+        self._replies = None
+
+    def __len__(self):
+        return len(self.intid)
+
+    def _id_index(self):
+        if self._sorted_ids is None:
+            order = numpy.argsort(self.intid, kind='stable')
+            self._sorted_ids = (order, self.intid[order])
+        return self._sorted_ids
+
+    def rowsOf(self, doc_ids):
+        """
+        The row of each of the intids in *doc_ids*, or :data:`MISSING`
+        for those that are not in the snapshot.
+        """
+        doc_ids = numpy.asarray(doc_ids, dtype=self.intid.dtype)
+        if not len(self):
+            return numpy.full(doc_ids.shape, MISSING, dtype=numpy.intp)
+        order, sorted_ids = self._id_index()
+        positions = numpy.searchsorted(sorted_ids, doc_ids)
+        positions = numpy.minimum(positions, len(sorted_ids) - 1)
+        found = (sorted_ids[positions] == doc_ids) & (doc_ids != MISSING)
+        return numpy.where(found, order[positions], MISSING)
+    rows_of = rowsOf
+
+    @property
+    def parentRows(self):
+        """
+        The row of the parent of each row, or :data:`MISSING` for roots
+        and for replies whose parents are not in the snapshot.
+        """
+        if self._parent_rows is None:
+            self._parent_rows = self.rowsOf(self.parent)
+        return self._parent_rows
+    parent_rows = parentRows
+
+    def _reply_index(self):
+        # The rows of the replies, grouped by parent (oldest first),
+        # and where the group of each row begins.
+        if self._replies is None:
+            parents = self.parentRows
+            rows = numpy.flatnonzero(parents != MISSING)
+            rows = rows[numpy.lexsort((self.created[rows], parents[rows]))]
+            offsets = numpy.zeros(len(self) + 1, dtype=numpy.intp)
+            numpy.cumsum(numpy.bincount(parents[rows], minlength=len(self)),
+                         out=offsets[1:])
+            self._replies = (rows, offsets)
+        return self._replies
+
+    def replyIds(self, doc_id):
+        """
+        The intids of the direct replies to *doc_id*, oldest first.
+        """
+        row = self.rowsOf(doc_id)
+        if row == MISSING:
+            return self.intid[:0]
+        rows, offsets = self._reply_index()
+        return self.intid[rows[offsets[row]:offsets[row + 1]]]
+    reply_ids = replyIds
+
+    def replyCount(self, doc_id):
+        """
+        The number of direct replies to *doc_id*.
+        """
+        row = self.rowsOf(doc_id)
+        if row == MISSING:
+            return 0
+        _, offsets = self._reply_index()
+        return int(offsets[row + 1] - offsets[row])
+    reply_count = replyCount
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, len(self))
+
+
+def load_thread_snapshot(path, mmap=True):
+    """
+    Load the snapshot written to the directory *path* by
+    :func:`export_thread_snapshot`.
+
+    :keyword bool mmap: If true (the default), the columns are
+        read-only memory maps of the files, so only the parts that
+        are used are read.
+    :rtype: ThreadSnapshot
+    """
+    mmap_mode = 'r' if mmap else None
+    columns = [numpy.load(_column_path(path, name), mmap_mode=mmap_mode)
+               for name, _ in COLUMNS]
+    return ThreadSnapshot(*columns)
@@ -8,27 +8,357 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import threading
+
+from contextlib import contextmanager
+
+from BTrees.Length import Length
+
 from zope import component
 
+from zope.event import notify
+
 from zope.intid.interfaces import IIntIds
 from zope.intid.interfaces import IIntIdAddedEvent
 from zope.intid.interfaces import IIntIdRemovedEvent
 
+from nti.threadable.cache import ancestor_chain_cache
+
+from nti.threadable.datastructures import ShardedTreeSet
+from nti.threadable.datastructures import MostRecentReply
+
+from nti.threadable.externalization import external_ntiid_cache
+
+from nti.threadable.instrumentation import measuring
+from nti.threadable.instrumentation import get_recorder
+from nti.threadable.instrumentation import current_measurement
+
 from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import IReferentQueue
+from nti.threadable.interfaces import ThreadWalkError
+from nti.threadable.interfaces import ThreadCycleError
+from nti.threadable.interfaces import ThreadTooDeepError
+from nti.threadable.interfaces import ThreadWalkAbortedEvent
 
+from nti.threadable.threadable import _created_time
 from nti.threadable.threadable import Threadable as ThreadableMixin
 
 logger = __import__('logging').getLogger(__name__)
 
+#: Per-thread state; see :func:`removing_subtree`
+_local = threading.local()
+
+#: The most ancestors a walk up a thread visits before giving up with
+#: a :class:`.ThreadTooDeepError`. This protects against corrupt data;
+#: real threads should be nowhere near this deep.
+MAX_ANCESTOR_DEPTH = 10000
+
 
 def discard(the_set, the_value):
+    """
+    Remove *the_value* from *the_set*, if present. Returns whether
+    anything was removed.
+    """
+    if the_value not in the_set:
+        return False
     try:
         the_set.discard(the_value)  # python sets
     except AttributeError:
-        try:
-            the_set.remove(the_value)  # BTrees..[Tree]Set. Also, python list
-        except (KeyError, ValueError):
-            pass
+        the_set.remove(the_value)  # BTrees..[Tree]Set. Also, python list
+    return True
+
+
+def _change_count(threadable, name, the_set, delta):
+    counter = getattr(threadable, name, None)
+    if counter is None:
+        # Lazily created. Seed it from the set so that objects
+        # that existed before we kept counts start out correct.
+        setattr(threadable, name, Length(len(the_set)))
+    else:
+        counter.change(delta)
+
+
+def _recompute_most_recent_reply(parent, intids):
+    # pylint: disable=protected-access
+    newest_id, newest_time = None, 0
+    for reply_id in parent._replies:
+        reply = intids.queryObject(reply_id)
+        if reply is None:
+            continue
+        created = _created_time(reply)
+        if newest_id is None or created >= newest_time:
+            newest_id, newest_time = reply_id, created
+    if parent._most_recent_reply is None:
+        parent._most_recent_reply = MostRecentReply(newest_id, newest_time)
+    else:
+        parent._most_recent_reply.update(newest_id, newest_time)
+
+
+def _record_most_recent_reply(parent, intids, key, added):
+    # pylint: disable=protected-access
+    current = getattr(parent, '_most_recent_reply', None)
+    if current is None and len(parent._replies) > added:
+        # Replies from before we maintained this; find the real newest once.
+        _recompute_most_recent_reply(parent, intids)
+        return
+    created, doc_id = key
+    if current is None:
+        parent._most_recent_reply = MostRecentReply(doc_id, created)
+    elif current.intid != doc_id \
+        and (current.intid is None or created >= current.createdTime):
+        current.update(doc_id, created)
+
+
+def _forget_most_recent_reply(parent, intids, doc_ids):
+    # pylint: disable=protected-access
+    current = getattr(parent, '_most_recent_reply', None)
+    if current is not None and current.intid in doc_ids:
+        # Only losing the newest requires looking at the others
+        _recompute_most_recent_reply(parent, intids)
+
+
+def _index_by_time(threadable, name, intids, keys, members):
+    if not getattr(threadable, '_maintain_time_index', False):
+        return
+    index = getattr(threadable, name)
+    if index is getattr(ThreadableMixin, name):
+        index = intids.family.OO.TreeSet()
+        setattr(threadable, name, index)
+        # Seed it from the set, so that objects with replies from
+        # before we kept the index start out complete.
+        for doc_id in members:
+            member = intids.queryObject(doc_id)
+            if member is not None:
+                index.add((_created_time(member), doc_id))
+    index.update(keys)
+
+
+def _unindex_by_time(threadable, name, keys):
+    index = getattr(threadable, name, None)
+    if index:
+        for key in keys:
+            discard(index, key)
+
+
+def _note(ancestor=False, created=False, changed=False):
+    # Count what we did for the instrumentation, if it's on
+    measurement = current_measurement()
+    if measurement is None:
+        return
+    if ancestor:
+        measurement.ancestors += 1
+    if created:
+        measurement.sets_created += 1
+    elif changed:
+        measurement.sets_mutated += 1
+
+
+# The following functions do the bookkeeping for one threadable and
+# any number of replies to it. Those are identified by a sorted
+# sequence of ``(createdTime, intid)`` keys.
+
+def _add_replies(parent, intids, keys):
+    # pylint: disable=protected-access
+    created = parent._replies is ThreadableMixin._replies
+    if created:
+        parent._replies = intids.family.II.TreeSet()
+    added = parent._replies.update(doc_id for _, doc_id in keys)
+    _note(created=created, changed=added)
+    if added:
+        _change_count(parent, '_reply_count', parent._replies, added)
+    _record_most_recent_reply(parent, intids, keys[-1], added)
+    _index_by_time(parent, '_replies_by_time', intids, keys, parent._replies)
+
+
+def _add_referents(ancestor, intids, keys):
+    # pylint: disable=protected-access
+    created = ancestor._referents is ThreadableMixin._referents
+    if created:
+        shards = getattr(ancestor, '_referents_shards', None)
+        if shards:
+            ancestor._referents = ShardedTreeSet(shards, intids.family)
+        else:
+            ancestor._referents = intids.family.II.TreeSet()
+    added = ancestor._referents.update(doc_id for _, doc_id in keys)
+    _note(ancestor=True, created=created, changed=added)
+    if added:
+        _change_count(ancestor, '_referent_count', ancestor._referents, added)
+    _index_by_time(ancestor, '_referents_by_time', intids, keys,
+                   ancestor._referents)
+
+
+def _remove_replies(parent, intids, keys):
+    # pylint: disable=protected-access
+    removed = [doc_id for _, doc_id in keys if discard(parent._replies, doc_id)]
+    _note(changed=removed)
+    if removed:
+        _change_count(parent, '_reply_count', parent._replies, -len(removed))
+        _forget_most_recent_reply(parent, intids, removed)
+    _unindex_by_time(parent, '_replies_by_time', keys)
+
+
+def _remove_referents(ancestor, keys):
+    # pylint: disable=protected-access
+    removed = [doc_id for _, doc_id in keys if discard(ancestor._referents, doc_id)]
+    _note(ancestor=True, changed=removed)
+    if removed:
+        _change_count(ancestor, '_referent_count', ancestor._referents, -len(removed))
+    _unindex_by_time(ancestor, '_referents_by_time', keys)
+
+
+def _resolve_ancestors(ancestor_ids, intids):
+    # The threadables for the intids, or None if any of them can't
+    # be resolved (and so the stored chain can't be trusted)
+    ancestors = []
+    for ancestor_id in ancestor_ids:
+        ancestor = intids.queryObject(ancestor_id)
+        ancestors.append(ancestor)
+        if not IThreadable.providedBy(ancestor):
+            break
+    measurement = current_measurement()
+    if measurement is not None:
+        measurement.intids_resolved += len(ancestors)
+    if ancestors and not IThreadable.providedBy(ancestors[-1]):
+        return None
+    return ancestors
+
+
+def _walk_aborted(error):
+    """
+    Report that a walk up a thread has been stopped by *error*.
+    """
+    logger.warning("Stopped walking the ancestors of %r after %s: %r",
+                   error.start, len(error.ancestors), error)
+    notify(ThreadWalkAbortedEvent(error.start, error))
+
+
+def _check_depth(start, ancestors):
+    if len(ancestors) > MAX_ANCESTOR_DEPTH:
+        error = ThreadTooDeepError(start, ancestors)
+        _walk_aborted(error)
+        raise error
+
+
+def _walk_ancestors(inReplyTo):
+    # The pointer chase: resolve each inReplyTo in turn. Objects are
+    # unique in a connection, so we can use their ids to find cycles.
+    start = inReplyTo
+    ancestors = []
+    seen = set()
+    while IThreadable.providedBy(inReplyTo):
+        if id(inReplyTo) in seen:
+            error = ThreadCycleError(start, ancestors)
+            _walk_aborted(error)
+            raise error
+        seen.add(id(inReplyTo))
+        ancestors.append(inReplyTo)
+        _check_depth(start, ancestors)
+        inReplyTo = inReplyTo.inReplyTo
+    measurement = current_measurement()
+    if measurement is not None:
+        measurement.weakrefs_resolved += len(ancestors)
+    return ancestors
+
+
+def _check_chain(inReplyTo, ancestor_ids):
+    # A stored chain can only be trusted if it has no repeats
+    _check_depth(inReplyTo, ancestor_ids)
+    if len(set(ancestor_ids)) != len(ancestor_ids):
+        error = ThreadCycleError(inReplyTo, ancestor_ids)
+        _walk_aborted(error)
+        raise error
+
+
+def _known_chain(threadable, doc_id):
+    """
+    The intids of the ancestors of *threadable*, if they are stored
+    on it or cached, or None.
+    """
+    # pylint: disable=protected-access
+    chain = getattr(threadable, '_ancestor_ids', None)
+    if chain is None and doc_id is not None:
+        chain = ancestor_chain_cache.get(doc_id, threadable)
+    return chain
+
+
+def _ancestor_chain(inReplyTo, intids):
+    """
+    Return a tuple ``(ancestor_ids, ancestors)`` for an object that is a
+    direct reply to *inReplyTo*: the intids of its ancestors, nearest
+    first (or None if they can't all be determined), and the ancestor
+    threadables themselves.
+
+    If the parent knows its own chain we build on that; only when
+    it doesn't, or it can't be resolved, do we chase the ``inReplyTo``
+    pointers.
+
+    :raises ThreadWalkError: If the ancestors form a cycle, or
+        there are too many of them.
+    """
+    parent_id = intids.queryId(inReplyTo)
+    parent_chain = _known_chain(inReplyTo, parent_id)
+    if parent_id is not None and parent_chain is not None:
+        _check_chain(inReplyTo, (parent_id,) + tuple(parent_chain))
+        ancestors = _resolve_ancestors(parent_chain, intids)
+        if ancestors is not None:
+            ancestors.insert(0, inReplyTo)
+            return (parent_id,) + tuple(parent_chain), ancestors
+
+    ancestors = _walk_ancestors(inReplyTo)
+    ancestor_ids = tuple(intids.queryId(x) for x in ancestors)
+    if None in ancestor_ids:
+        ancestor_ids = None
+    elif parent_id is not None:
+        # Don't walk this way again
+        ancestor_chain_cache.set(parent_id, inReplyTo, ancestor_ids[1:])
+    return ancestor_ids, ancestors
+
+
+def _ancestors_of(threadable, intids):
+    """
+    The threadable ancestors of *threadable*, nearest first, using its
+    stored (or cached) chain when it can be resolved.
+    """
+    ancestor_ids = _known_chain(threadable, intids.queryId(threadable))
+    if ancestor_ids is not None:
+        ancestors = _resolve_ancestors(ancestor_ids, intids)
+        if ancestors is not None:
+            return ancestors
+    try:
+        return _walk_ancestors(threadable.inReplyTo)
+    except ThreadWalkError as e:
+        # This is used when removing; even broken threadables
+        # must be removable, so clean up what we found.
+        return list(e.ancestors)
+
+
+def _thread_position(inReplyTo, ancestor_ids, ancestors, intids):
+    """
+    The ``(threadRootId, threadDepth)`` of a direct reply to *inReplyTo*.
+    These come straight from the parent if it knows its own; otherwise,
+    from the ancestor chain.
+    """
+    # pylint: disable=protected-access
+    root_id = getattr(inReplyTo, '_threadRootId', None)
+    depth = getattr(inReplyTo, '_threadDepth', None)
+    if root_id is not None and depth is not None:
+        return root_id, depth + 1
+    if ancestor_ids:
+        return ancestor_ids[-1], len(ancestor_ids)
+    root_id = intids.queryId(ancestors[-1])
+    return root_id, (len(ancestors) if root_id is not None else None)
+
+
+def _stored_ancestor_ids(inReplyTo, intids):
+    # The intids of the ancestors of a reply to *inReplyTo*, if they
+    # can be had without resolving anything.
+    parent_id = intids.queryId(inReplyTo)
+    parent_chain = _known_chain(inReplyTo, parent_id)
+    if parent_id is None or parent_chain is None:
+        return None
+    ancestor_ids = (parent_id,) + tuple(parent_chain)
+    _check_chain(inReplyTo, ancestor_ids)
+    return ancestor_ids
 
 
 def _do_threadable_added(threadable, intids, doc_id):
@@ -38,18 +368,29 @@ def _do_threadable_added(threadable, intids, doc_id):
         return  # nothing to do
 
     # pylint: disable=protected-access
+    queue = component.queryUtility(IReferentQueue)
+    ancestors = None
+    ancestor_ids = _stored_ancestor_ids(inReplyTo, intids) if queue is not None else None
+    if ancestor_ids is None:
+        ancestor_ids, ancestors = _ancestor_chain(inReplyTo, intids)
+    threadable._ancestor_ids = ancestor_ids
+    threadable._inReplyToId = ancestor_ids[0] if ancestor_ids else intids.queryId(inReplyTo)
+    threadable._threadRootId, threadable._threadDepth = \
+        _thread_position(inReplyTo, ancestor_ids, ancestors, intids)
+
+    keys = [(_created_time(threadable), doc_id)]
     # Only the direct parent gets added as a reply
-    if inReplyTo._replies is ThreadableMixin._replies:
-        inReplyTo._replies = intids.family.II.TreeSet()
-    inReplyTo._replies.add(doc_id)
+    _add_replies(inReplyTo, intids, keys)
 
-    # Now walk up the tree and record the indirect reference (including in the direct
-    # parent)
-    while IThreadable.providedBy(inReplyTo):
-        if inReplyTo._referents is ThreadableMixin._referents:
-            inReplyTo._referents = intids.family.II.TreeSet()
-        inReplyTo._referents.add(doc_id)
-        inReplyTo = inReplyTo.inReplyTo
+    if queue is not None and ancestor_ids:
+        # The referents are updated when the queue is drained
+        queue.added(keys, ancestor_ids)
+        return
+
+    # Now record the indirect reference in every ancestor (including in the
+    # direct parent)
+    for ancestor in ancestors:
+        _add_referents(ancestor, intids, keys)
 _threadable_added = _do_threadable_added # BWC
 
 
@@ -59,24 +400,146 @@ def threadable_added(threadable, _):
     Update the replies and referents. NOTE: This assumes that IThreadable is actually
     a ThreadableMixin.
     """
+    recorder = get_recorder()
+    if recorder is None:
+        _added(threadable)
+    else:
+        with measuring(recorder, 'added'):
+            _added(threadable)
+
+
+def _added(threadable):
     # Note that we don't trust the 'references' value of the client.
     # we build the reference chain ourself based on inReplyTo.
     inReplyTo = threadable.inReplyTo
+    intids = component.getUtility(IIntIds)
     # None in the real world, test case stuff otherwise
     if not IThreadable.providedBy(inReplyTo):
-        return  # nothing to do
+        # A root; its replies can build on its (empty) chain
+        # and position.
+        threadable._ancestor_ids = ()
+        threadable._threadRootId = intids.queryId(threadable)
+        threadable._threadDepth = 0
+        return
 
-    intids = component.getUtility(IIntIds)
     doc_id = intids.getId(threadable)
     _do_threadable_added(threadable, intids, doc_id)
 
 
+class _SubtreeRemoval(object):
+    """
+    The state of a :func:`removing_subtree` block.
+    """
+
+    def __init__(self, root, intids):
+        self.root = root
+        self.intids = intids
+        self.root_id = intids.queryId(root)
+        # pylint: disable=protected-access
+        self.doc_ids = set(getattr(root, '_referents', ()))
+        if self.root_id is not None:
+            self.doc_ids.add(self.root_id)
+        # The doc_id -> createdTime of the objects actually removed
+        self.removed = {}
+        # The doc_ids of those that are direct replies to the root
+        self.children = set()
+
+    def _is_child(self, threadable):
+        # pylint: disable=protected-access
+        parent_id = getattr(threadable, '_inReplyToId', None)
+        if parent_id is None and threadable.inReplyTo is not None:
+            parent_id = self.intids.queryId(threadable.inReplyTo)
+        return self.root_id is not None and parent_id == self.root_id
+
+    def suppress(self, threadable):
+        doc_id = self.intids.queryId(threadable)
+        if doc_id not in self.doc_ids:
+            return False
+        self.removed[doc_id] = _created_time(threadable)
+        if self._is_child(threadable):
+            self.children.add(doc_id)
+        return True
+
+    def apply(self):
+        root, intids = self.root, self.intids
+        keys = sorted((created, doc_id) for doc_id, created in self.removed.items())
+        if not keys:
+            return
+        ancestors = _ancestors_of(root, intids)
+        if self.root_id in self.removed:
+            if ancestors:
+                root_keys = [(self.removed[self.root_id], self.root_id)]
+                _remove_replies(ancestors[0], intids, root_keys)
+        else:
+            # The root survives; only its descendants went away
+            child_keys = [key for key in keys if key[1] in self.children]
+            if child_keys:
+                _remove_replies(root, intids, child_keys)
+            ancestors.insert(0, root)
+        for ancestor in ancestors:
+            _remove_referents(ancestor, keys)
+
+        queue = component.queryUtility(IReferentQueue)
+        if queue is not None:
+            # Additions still waiting in the queue must not bring
+            # these back when it is drained
+            ancestor_ids = (intids.queryId(x) for x in ancestors)
+            queue.removed(keys, [x for x in ancestor_ids if x is not None])
+
+
+def _suppressed(threadable):
+    for removal in getattr(_local, 'subtree_removals', ()):
+        if removal.suppress(threadable):
+            return True
+    return False
+
+
+@contextmanager
+def removing_subtree(root, intids=None):
+    """
+    A context manager for removing *root* and all of its descendants.
+
+    Within the block, removing any of those objects does not update the
+    threads: the removal events are only noted. When the block exits
+    normally, the objects actually removed are taken out of the
+    replies and referents of the surviving ancestors of *root* all at
+    once, so each ancestor is written once instead of once per
+    removed object. (If the block raises an exception, nothing is
+    done.)
+
+    The descendants are expected to be removed along with the root.
+    Any that are not removed, but have removed descendants, keep those
+    descendants in their referents.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    removal = _SubtreeRemoval(root, intids)
+    removals = _local.__dict__.setdefault('subtree_removals', [])
+    removals.append(removal)
+    try:
+        yield removal
+    finally:
+        removals.remove(removal)
+    removal.apply()
+
+
 @component.adapter(IThreadable, IIntIdRemovedEvent)
 def threadable_removed(threadable, _):
     """
     Update the replies and referents. NOTE: This assumes that IThreadable 
     is actually a ThreadableMixin.
     """
+    recorder = get_recorder()
+    if recorder is None:
+        _removed(threadable)
+    else:
+        with measuring(recorder, 'removed'):
+            _removed(threadable)
+
+
+def _removed(threadable):
+    if getattr(_local, 'subtree_removals', None) and _suppressed(threadable):
+        return  # handled when the subtree is done
+
     # Note that we don't trust the 'references' value of the client.
     # we build the reference chain ourself based on inReplyTo.
     inReplyTo = threadable.inReplyTo
@@ -85,18 +548,41 @@ def threadable_removed(threadable, _):
 
     intids = component.getUtility(IIntIds)
     intid = intids.getId(threadable)
-    # pylint: disable=protected-access
+    keys = [(_created_time(threadable), intid)]
     # Only the direct parent gets added as a reply
     try:
-        discard(inReplyTo._replies, intid)
+        _remove_replies(inReplyTo, intids, keys)
     except AttributeError:
         pass
 
-    # Now walk up the tree and record the indirect reference (including in the direct
-    # parent)
-    while IThreadable.providedBy(inReplyTo):
+    queue = component.queryUtility(IReferentQueue)
+    ancestor_ids = getattr(threadable, '_ancestor_ids', None)
+    if queue is not None and ancestor_ids:
+        queue.removed(keys, ancestor_ids)
+        return
+
+    # Now remove the indirect reference from every ancestor (including the
+    # direct parent)
+    for ancestor in _ancestors_of(threadable, intids):
         try:
-            discard(inReplyTo._referents, intid)
+            _remove_referents(ancestor, keys)
         except AttributeError:
             pass
-        inReplyTo = inReplyTo.inReplyTo
+
+
+@component.adapter(IThreadable, IIntIdRemovedEvent)
+def invalidate_external_ntiid(threadable, _):
+    """
+    Forget the cached external NTIID of a removed threadable.
+    """
+    external_ntiid_cache.invalidate(threadable)
+
+
+@component.adapter(IThreadable, IIntIdRemovedEvent)
+def invalidate_ancestor_chain(threadable, _):
+    """
+    Forget the cached ancestors of a removed threadable.
+    """
+    doc_id = component.getUtility(IIntIds).queryId(threadable)
+    if doc_id is not None:
+        ancestor_chain_cache.invalidate(doc_id)
@@ -45,8 +45,13 @@ class ThreadableLayerTest(unittest.TestCase):
     layer = SharedConfiguringTestLayer
 
 
+import BTrees
+
+from zope import component
 from zope import interface
 
+from zope.intid.interfaces import IIntIds
+
 from persistent import Persistent
 
 from nti.externalization.datastructures import InterfaceObjectIO
@@ -55,6 +60,8 @@ from nti.threadable.threadable import Threadable
 
 from nti.threadable.externalization import ThreadableExternalizableMixin
 
+from nti.threadable.subscribers import threadable_added
+
 
 class IPThreadable(interface.Interface):
     pass
@@ -65,6 +72,92 @@ class PThreadable(Persistent, Threadable):
     pass
 
 
+class TimeIndexed(PThreadable):
+    _maintain_time_index = True
+
+
 class PInternalObjectIO(ThreadableExternalizableMixin,
                         InterfaceObjectIO):
     _ext_iface_upper_bound = IPThreadable
+
+
+class MockIntIds(object):
+
+    family = BTrees.family64
+
+    def __init__(self):
+        self.objects = {}
+
+    def register(self, obj):
+        self.objects[id(obj)] = obj
+        return obj
+
+    def getId(self, obj):
+        return id(obj)
+    queryId = getId
+
+    def queryObject(self, doc_id, default=None):
+        return self.objects.get(doc_id, default)
+
+    def __iter__(self):
+        return iter(list(self.objects))
+
+
+class MockDB(object):
+    database_name = 'mock'
+
+
+class MockJar(object):
+    """
+    Just enough of a ZODB connection for the tests.
+    """
+
+    collected = 0
+
+    def __init__(self):
+        self.prefetched = []
+
+    def db(self):
+        return MockDB()
+
+    def prefetch(self, objects):
+        self.prefetched.append(list(objects))
+
+    def cacheGC(self):
+        self.collected += 1
+
+
+def create_threadable(intids, parent=None, createdTime=0, factory=PThreadable,
+                      added=True):
+    """
+    Register a new threadable with *intids* and, if *added*, notify
+    the subscribers that it was added.
+    """
+    obj = intids.register(factory())
+    obj.createdTime = createdTime
+    obj.inReplyTo = parent
+    if added:
+        threadable_added(obj, None)
+    return obj
+
+
+class IntIdsLayerTest(ThreadableLayerTest):
+    """
+    Registers a new :class:`MockIntIds` as the intid utility for each
+    test.
+    """
+
+    factory = PThreadable
+
+    def setUp(self):
+        super(IntIdsLayerTest, self).setUp()
+        self.intids = MockIntIds()
+        component.getGlobalSiteManager().registerUtility(self.intids, IIntIds)
+
+    def tearDown(self):
+        component.getGlobalSiteManager().unregisterUtility(self.intids, IIntIds)
+        super(IntIdsLayerTest, self).tearDown()
+
+    def _create(self, parent=None, createdTime=0, factory=None):
+        return create_threadable(self.intids, parent, createdTime,
+                                 factory or self.factory)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+
+import unittest
+
+import numpy
+
+from nti.threadable.analytics import thread_statistics
+from nti.threadable.analytics import propagate_thread_roots
+
+from nti.threadable.snapshot import MISSING
+from nti.threadable.snapshot import ThreadSnapshot
+
+
+def _snapshot(rows):
+    """
+    A snapshot of ``(intid, parent, created)`` rows.
+    """
+    intid, parent, created = (numpy.array(x) for x in zip(*rows))
+    unknown = numpy.full(len(rows), MISSING)
+    return ThreadSnapshot(intid, parent, unknown, unknown, created)
+
+
+class TestAnalytics(unittest.TestCase):
+
+    def test_propagate(self):
+        #   0       5
+        #  / \      |
+        # 1   3     6 -> 7 -> 6 (a cycle)
+        # |         |
+        # 2         8 (below it)
+        # |
+        # 4
+        parents = [MISSING, 0, 1, 0, 2, MISSING, 7, 6, 6]
+        roots, depths = propagate_thread_roots(parents)
+        assert_that(roots.tolist(),
+                    is_([0, 0, 0, 0, 0, 5, MISSING, MISSING, MISSING]))
+        assert_that(depths.tolist(),
+                    is_([0, 1, 2, 1, 3, 0, MISSING, MISSING, MISSING]))
+
+    def test_propagate_deep(self):
+        count = 1000
+        parents = numpy.arange(-1, count - 1)
+        roots, depths = propagate_thread_roots(parents)
+        assert_that(roots.tolist(), is_([0] * count))
+        assert_that(depths.tolist(), is_(list(range(count))))
+
+    def test_propagate_empty(self):
+        roots, depths = propagate_thread_roots([])
+        assert_that(roots, has_length(0))
+        assert_that(depths, has_length(0))
+
+    def test_statistics(self):
+        hour = 3600
+        snapshot = _snapshot([
+            # A thread rooted at 10
+            (10, MISSING, 0),
+            (11, 10, hour),
+            (12, 10, 2 * hour),
+            (13, 10, 3 * hour),
+            (14, 11, 4 * hour),
+            # A thread without replies
+            (20, MISSING, 0),
+            # A reply whose parent isn't in the snapshot,
+            # and a reply to it
+            (30, 99, 10),
+            (31, 30, 20),
+            # A cycle
+            (40, 41, 0),
+            (41, 40, 0),
+        ])
+        stats = thread_statistics(snapshot)
+        assert_that(stats, has_length(3))
+        assert_that(stats.rootIds.tolist(), is_([10, 20, 30]))
+        assert_that(stats.size.tolist(), is_([5, 1, 2]))
+        assert_that(stats.replyCount.tolist(), is_([4, 0, 1]))
+        assert_that(stats.maxDepth.tolist(), is_([2, 0, 1]))
+        assert_that(stats.firstCreated.tolist(), is_([0, 0, 10]))
+        assert_that(stats.lastCreated.tolist(), is_([4 * hour, 0, 20]))
+        assert_that(stats.maxFanOut.tolist(), is_([3, 0, 1]))
+        # Short spans count as an hour
+        assert_that(stats.repliesPerHour.tolist(), is_([1.0, 0.0, 1.0]))
+        # Five with no replies, four with one (11, 30, and 40 and 41 in
+        # the cycle) and the root with three
+        assert_that(stats.fanOutHistogram.tolist(), is_([5, 4, 0, 1]))
+        repr(stats)
+
+    def test_statistics_empty(self):
+        stats = thread_statistics(ThreadSnapshot(*[numpy.zeros(0)] * 5))
+        assert_that(stats, has_length(0))
+        assert_that(stats.size.tolist(), is_([]))
+        assert_that(stats.fanOutHistogram.tolist(), is_([]))
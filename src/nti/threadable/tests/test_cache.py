@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+
+import unittest
+
+from nti.threadable.cache import LRUCache
+from nti.threadable.cache import AncestorChainCache
+
+
+class Versioned(object):
+
+    def __init__(self, oid, serial=b'1'):
+        self._p_oid = oid
+        self._p_serial = serial
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_bounded(self):
+        with self.assertRaises(ValueError):
+            LRUCache(0)
+
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert_that(cache.get('a'), is_(1))
+        # b is now the least recently used
+        cache.set('c', 3)
+        assert_that(cache, has_length(2))
+        assert_that('b' in cache, is_(False))
+        assert_that(cache.get('b'), is_(none()))
+        assert_that(cache.get('b', 42), is_(42))
+        assert_that(cache, has_property('hits', 1))
+        assert_that(cache, has_property('misses', 2))
+
+        cache.set('a', 4)
+        assert_that(cache.get('a'), is_(4))
+        assert_that(cache.pop('a'), is_(4))
+        assert_that(cache.pop('a'), is_(none()))
+        repr(cache)
+
+        cache.clear()
+        assert_that(cache, has_length(0))
+
+
+class TestAncestorChainCache(unittest.TestCase):
+
+    def test_validated(self):
+        cache = AncestorChainCache(10)
+        obj = Versioned(b'a')
+        assert_that(cache.get(1, obj), is_(none()))
+        cache.set(1, obj, [2, 3])
+        assert_that(cache.get(1, obj), is_((2, 3)))
+        assert_that(cache, has_length(1))
+        assert_that(cache, has_property('hits', 1))
+        assert_that(cache, has_property('misses', 1))
+
+        # Another object with the same intid
+        assert_that(cache.get(1, Versioned(b'b')), is_(none()))
+        assert_that(cache, has_length(0))
+
+        # The object changed
+        cache.set(1, obj, [2, 3])
+        obj._p_serial = b'2'
+        assert_that(cache.get(1, obj), is_(none()))
+
+        cache.set(1, obj, [2, 3])
+        cache.invalidate(1)
+        cache.invalidate(1)
+        assert_that(cache.get(1, obj), is_(none()))
+
+        # Without an oid, nothing is cached
+        cache.set(2, object(), [1])
+        assert_that(cache, has_length(0))
+
+        cache.set(1, obj, [2, 3])
+        cache.clear()
+        assert_that(cache, has_length(0))
+        repr(cache)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import assert_that
+from hamcrest import has_property
+from hamcrest import contains_inanyorder
+
+import unittest
+
+from zope.catalog.catalog import Catalog
+
+from nti.threadable.catalog import ThreadMembership
+
+from nti.threadable.catalog import thread_root_ids
+from nti.threadable.catalog import query_thread_members
+from nti.threadable.catalog import install_thread_indexes
+
+from nti.threadable.interfaces import IThreadMembership
+
+from nti.threadable.tests import PThreadable
+from nti.threadable.tests import SharedConfiguringTestLayer
+
+
+class PlainThreadable(object):
+    inReplyTo = None
+
+
+class TestCatalog(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def _threadable(self, catalog, doc_id, parent=None):
+        obj = PThreadable()
+        obj._inReplyToId = doc_id // 10 if parent else None
+        obj._threadRootId = parent._threadRootId if parent else doc_id
+        obj._threadDepth = parent._threadDepth + 1 if parent else 0
+        if parent is not None:
+            obj.addReference(parent)
+        catalog.index_doc(doc_id, obj)
+        return obj
+
+    def test_membership(self):
+        obj = PThreadable()
+        membership = IThreadMembership(obj)
+        assert_that(membership, is_(ThreadMembership))
+        assert_that(membership, has_property('threadRootId', is_(none())))
+        assert_that(membership, has_property('isOrWasChildInThread', False))
+        obj._inReplyTo = object()
+        assert_that(membership, has_property('isOrWasChildInThread', True))
+        # Something that only has inReplyTo
+        membership = ThreadMembership(PlainThreadable())
+        assert_that(membership, has_property('threadDepth', is_(none())))
+        assert_that(membership, has_property('isOrWasChildInThread', False))
+
+    def test_query(self):
+        catalog = Catalog()
+        assert_that(install_thread_indexes(catalog),
+                    is_(['threadRootId', 'inReplyToId',
+                         'threadDepth', 'isOrWasChildInThread']))
+        assert_that(install_thread_indexes(catalog), is_([]))
+
+        # Two threads: 1 <- 10 <- 100, 1 <- 11; and 2 <- 20
+        one = self._threadable(catalog, 1)
+        ten = self._threadable(catalog, 10, one)
+        self._threadable(catalog, 100, ten)
+        self._threadable(catalog, 11, one)
+        two = self._threadable(catalog, 2)
+        self._threadable(catalog, 20, two)
+
+        assert_that(query_thread_members(catalog), is_(none()))
+        assert_that(list(query_thread_members(catalog, root_ids=(1,))),
+                    contains_inanyorder(1, 10, 11, 100))
+        assert_that(list(query_thread_members(catalog, root_ids=(1, 2),
+                                              max_depth=1)),
+                    contains_inanyorder(1, 2, 10, 11, 20))
+        assert_that(list(query_thread_members(catalog, root_ids=(1,),
+                                              min_depth=2)),
+                    is_([100]))
+        assert_that(list(query_thread_members(catalog, parent_ids=(1, 10))),
+                    contains_inanyorder(10, 11, 100))
+        assert_that(list(query_thread_members(catalog, top_level=True)),
+                    is_([1, 2]))
+        assert_that(list(query_thread_members(catalog, top_level=False,
+                                              root_ids=(2,))),
+                    is_([20]))
+        assert_that(list(query_thread_members(catalog, root_ids=(3,),
+                                              top_level=False)),
+                    is_([]))
+
+        assert_that(list(thread_root_ids(catalog, (100, 20, 11, 42))),
+                    is_([1, 2]))
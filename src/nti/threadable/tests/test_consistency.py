@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+from hamcrest import contains_inanyorder
+
+from nti.threadable.consistency import REPLIES
+from nti.threadable.consistency import REFERENTS
+
+from nti.threadable.consistency import find_thread_inconsistencies
+from nti.threadable.consistency import repair_thread_inconsistencies
+
+from nti.threadable.subscribers import discard
+
+from nti.threadable.tests import MockJar
+from nti.threadable.tests import TimeIndexed
+from nti.threadable.tests import IntIdsLayerTest
+
+
+class TestConsistency(IntIdsLayerTest):
+
+    factory = TimeIndexed
+
+    def _thread(self):
+        root = self._create(None, 0)
+        first = self._create(root, 1)
+        nested = self._create(first, 2)
+        second = self._create(root, 3)
+        return root, first, nested, second
+
+    def _found(self, objects=None, **kwargs):
+        return [(x.intid, x.name, x.missing, x.extra, x.countDrift)
+                for x in find_thread_inconsistencies(objects, **kwargs)]
+
+    def test_consistent(self):
+        root, first, nested, second = self._thread()
+        other = self._create(None, 4)
+        assert_that(self._found(), is_([]))
+        assert_that(self._found([root, first, nested, second, other, object()]),
+                    is_([]))
+
+        # The cache is collected after each batch
+        jar = other._p_jar = MockJar()
+        assert_that(self._found([root, other], batch_size=1), is_([]))
+        assert_that(jar, has_property('collected', 1))
+
+        # Including between batches of the members of one set
+        jar = root._p_jar = MockJar()
+        assert_that(self._found([root], batch_size=2, max_cached_chains=0),
+                    is_([]))
+        assert_that(jar, has_property('collected', 3))
+
+    def test_find_and_repair(self):
+        root, first, nested, second = self._thread()
+        other = self._create(None, 4)
+        ids = [id(x) for x in (root, first, nested, second, other)]
+        root_id, first_id, nested_id, second_id, other_id = ids
+
+        # Lost by a failed subscriber
+        discard(first._replies, nested_id)
+        discard(root._referents, nested_id)
+        # Left behind by a suppressed removal
+        root._replies.add(42)
+        root._replies_by_time.add((5, 42))
+        # Not below it
+        first._referents.add(other_id)
+        second._referents = self.intids.family.II.TreeSet([root_id])
+        # Miscounted
+        second._reply_count = root._reply_count.__class__(3)
+
+        found = self._found(max_cached_chains=1)
+        assert_that(found, contains_inanyorder(
+            (root_id, REPLIES, (), (42,), -1),
+            (root_id, REFERENTS, (nested_id,), (), 1),
+            (first_id, REPLIES, (nested_id,), (), 1),
+            (first_id, REFERENTS, (), (other_id,), -1),
+            (second_id, REPLIES, (), (), 3),
+            (second_id, REFERENTS, (), (root_id,), 0),
+        ))
+
+        # Fewer objects, fewer checks
+        assert_that(self._found([other]), is_([]))
+
+        # In smaller batches, the differences of a set may be found in
+        # more than one batch: nested is only seen to be missing from
+        # root's referents and first's replies in the second one.
+        count = repair_thread_inconsistencies(batch_size=2, savepoint_every=100)
+        assert_that(count, is_(len(found) + 2))
+        assert_that(self._found(), is_([]))
+
+        assert_that(list(root._replies), contains_inanyorder(first_id, second_id))
+        assert_that(list(root._replies_by_time), is_([(1, first_id), (3, second_id)]))
+        assert_that(list(root._referents),
+                    contains_inanyorder(first_id, nested_id, second_id))
+        assert_that(root, has_property('replyCount', 2))
+        assert_that(root, has_property('referentCount', 3))
+        assert_that(list(first._replies), is_([nested_id]))
+        assert_that(list(first._referents), is_([nested_id]))
+        assert_that(first, has_property('referentCount', 1))
+        assert_that(second, has_property('replyCount', 0))
+        assert_that(list(second._referents), is_([]))
+
+    def test_repair_is_lazy(self):
+        root, first, _, _ = self._thread()
+        discard(root._replies, id(first))
+        found = find_thread_inconsistencies(repair=True)
+        assert_that(list(root._replies), has_length(1))
+        found = list(found)
+        assert_that(found, has_length(1))
+        assert_that(list(root._replies), has_length(2))
+        assert_that(repr(found[0]),
+                    is_('<ThreadInconsistency %s replies missing=[%s] extra=[] countDrift=1>'
+                        % (id(root), id(first))))
+
+    def test_cycle(self):
+        root, first, nested, _ = self._thread()
+        root.inReplyTo = nested
+        # Nothing can be said about the threadables in the cycle
+        found = self._found([root, first, nested])
+        assert_that(found, is_([]))
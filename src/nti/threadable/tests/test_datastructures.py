@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import raises
+from hamcrest import calling
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+
+import unittest
+
+from nti.threadable.datastructures import ShardedTreeSet
+from nti.threadable.datastructures import MostRecentReply
+
+
+class TestMostRecentReply(unittest.TestCase):
+
+    def test_defaults(self):
+        pointer = MostRecentReply()
+        assert_that(pointer, has_property('intid', is_(none())))
+        assert_that(pointer, has_property('createdTime', is_(0)))
+        repr(pointer)
+
+    def test_resolve_conflict(self):
+        pointer = MostRecentReply()
+        old = {'intid': 1, 'createdTime': 1}
+        older = {'intid': 2, 'createdTime': 0.5}
+        newer = {'intid': 3, 'createdTime': 2}
+        assert_that(pointer._p_resolveConflict(old, older, newer),
+                    is_(newer))
+        assert_that(pointer._p_resolveConflict(old, newer, older),
+                    is_(newer))
+        assert_that(pointer._p_resolveConflict(None, None, newer),
+                    is_(newer))
+
+
+class TestShardedTreeSet(unittest.TestCase):
+
+    def test_set(self):
+        assert_that(calling(ShardedTreeSet).with_args(0), raises(ValueError))
+
+        the_set = ShardedTreeSet(4)
+        assert_that(the_set, has_property('shards', has_length(4)))
+        assert_that(bool(the_set), is_(False))
+        assert_that(the_set.update([5, 1, 9, 2, 5]), is_(4))
+        assert_that(the_set.update([1, 3]), is_(1))
+        assert_that(the_set.add(3), is_(0))
+        assert_that(the_set.add(4), is_(1))
+        assert_that(bool(the_set), is_(True))
+        assert_that(the_set, has_length(6))
+        assert_that(list(the_set), is_([1, 2, 3, 4, 5, 9]))
+        assert_that(9 in the_set, is_(True))
+        assert_that(the_set.has_key(8), is_(False))
+        # Spread across the shards
+        assert_that([len(shard) for shard in the_set.shards],
+                    is_([1, 3, 1, 1]))
+
+        the_set.remove(9)
+        assert_that(list(the_set), is_([1, 2, 3, 4, 5]))
+        assert_that(calling(the_set.remove).with_args(9), raises(KeyError))
+        repr(the_set)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+
+import unittest
+
+import transaction
+
+from zope import component
+
+from nti.testing.matchers import verifiably_provides
+
+from nti.threadable.deferred import ReferentQueue
+from nti.threadable.deferred import flush_referent_queue
+from nti.threadable.deferred import drain_referent_queue
+from nti.threadable.deferred import process_referent_queue
+
+from nti.threadable.interfaces import IReferentQueue
+
+from nti.threadable.subscribers import removing_subtree
+from nti.threadable.subscribers import threadable_removed
+
+from nti.threadable.tests import IntIdsLayerTest
+
+
+class TestReferentQueue(unittest.TestCase):
+
+    def test_queue(self):
+        queue = ReferentQueue()
+        assert_that(queue, verifiably_provides(IReferentQueue))
+        assert_that(queue, has_length(0))
+        assert_that(queue.take(), is_([]))
+
+        queue.added([(1, 10)], (1,))
+        queue.removed([(1, 10)], (1,))
+        queue.added([(2, 20)], (2, 1))
+        assert_that(queue, has_length(3))
+        assert_that(queue.take(2), is_([(True, ((1, 10),), (1,)),
+                                        (False, ((1, 10),), (1,))]))
+        assert_that(queue, has_length(1))
+        assert_that(queue.take(), is_([(True, ((2, 20),), (2, 1))]))
+        assert_that(queue, has_length(0))
+        repr(queue)
+
+
+class TestDeferred(IntIdsLayerTest):
+
+    def setUp(self):
+        super(TestDeferred, self).setUp()
+        self.queue = ReferentQueue()
+        component.getGlobalSiteManager().registerUtility(self.queue, IReferentQueue)
+
+    def tearDown(self):
+        component.getGlobalSiteManager().unregisterUtility(self.queue, IReferentQueue)
+        super(TestDeferred, self).tearDown()
+
+    def test_deferred(self):
+        root = self._create()
+        first = self._create(root, 1)
+        second = self._create(first, 2)
+
+        # The replies are up to date, the referents are waiting
+        assert_that(list(root._replies), is_([id(first)]))
+        assert_that(list(first._replies), is_([id(second)]))
+        assert_that(root, has_property('referentCount', 0))
+        assert_that(second, has_property('threadDepth', 2))
+        assert_that(self.queue, has_length(2))
+
+        assert_that(flush_referent_queue(), is_(2))
+        assert_that(sorted(root._referents), is_(sorted([id(first), id(second)])))
+        assert_that(list(first._referents), is_([id(second)]))
+        assert_that(root, has_property('referentCount', 2))
+
+        # Removing, too
+        threadable_removed(second, None)
+        assert_that(list(first._replies), is_([]))
+        assert_that(root, has_property('referentCount', 2))
+        assert_that(flush_referent_queue(), is_(1))
+        assert_that(list(root._referents), is_([id(first)]))
+        assert_that(list(first._referents), is_([]))
+
+        # Adding and removing before the queue is drained
+        third = self._create(first, 3)
+        threadable_removed(third, None)
+        assert_that(drain_referent_queue(self.queue, self.intids), is_(2))
+        assert_that(list(root._referents), is_([id(first)]))
+
+        # Whatever order they are taken in, something that is gone
+        # isn't added back
+        fifth = self._create(first, 5)
+        threadable_removed(fifth, None)
+        del self.intids.objects[id(fifth)]
+        entries = self.queue.take()
+        self.queue.removed(*entries[1][1:])
+        self.queue.added(*entries[0][1:])
+        assert_that(entries[0][0], is_(True))
+        flush_referent_queue()
+        assert_that(list(root._referents), is_([id(first)]))
+        assert_that(root, has_property('referentCount', 1))
+
+        # Ancestors that are gone are skipped
+        fourth = self._create(first, 4)
+        del self.intids.objects[id(root)]
+        flush_referent_queue()
+        assert_that(list(first._referents), is_([id(fourth)]))
+
+    def test_unknown_chain(self):
+        root = self._create()
+        first = self._create(root, 1)
+        # Without a chain of intids, the referents are updated as usual
+        first._ancestor_ids = None
+        self.intids.queryId = lambda obj: None if obj is root else id(obj)
+        second = self._create(first, 2)
+        assert_that(list(first._referents), is_([id(second)]))
+        second._ancestor_ids = None
+        threadable_removed(second, None)
+        assert_that(list(first._referents), is_([]))
+        assert_that(self.queue, has_length(1))
+
+    def test_removing_subtree(self):
+        root = self._create()
+        first = self._create(root, 1)
+        second = self._create(first, 2)
+        # The removal comes after the queued additions
+        with removing_subtree(first):
+            threadable_removed(second, None)
+            threadable_removed(first, None)
+        assert_that(list(root._replies), is_([]))
+        flush_referent_queue()
+        assert_that(list(root._referents), is_([]))
+
+    def test_process(self):
+        root = self._create()
+        for i in range(5):
+            self._create(root, i)
+        assert_that(process_referent_queue(batch_size=2), is_(5))
+        assert_that(process_referent_queue(transaction_manager=transaction.manager),
+                    is_(0))
+        assert_that(root, has_property('referentCount', 5))
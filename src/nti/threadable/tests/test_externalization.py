@@ -8,6 +8,7 @@ from __future__ import absolute_import
 # pylint: disable=protected-access,too-many-public-methods
 
 from hamcrest import is_
+from hamcrest import contains
 from hamcrest import none
 from hamcrest import is_not
 from hamcrest import has_entry
@@ -18,11 +19,24 @@ from hamcrest import has_property
 import fudge
 import unittest
 
+import transaction
+
+from zope import interface
+
+from nti.threadable.externalization import external_ntiid_cache
+from nti.threadable.externalization import to_external_threadables
+from nti.threadable.externalization import external_reference_memo
+
+from nti.threadable.interfaces import IThreadable
+
+from nti.threadable.subscribers import invalidate_external_ntiid
+
+from nti.threadable.tests import MockJar
+from nti.threadable.tests import IPThreadable
 from nti.threadable.tests import PThreadable
 from nti.threadable.tests import PInternalObjectIO
 from nti.threadable.tests import SharedConfiguringTestLayer
 
-
 class TestExternalization(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -77,6 +91,36 @@ class TestExternalization(unittest.TestCase):
         assert_that(pio.toExternalObject(),
                     has_entry('inReplyTo', 'missing'))
 
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_export_other_threadables(self, mock_oid):
+        mock_oid.is_callable().calls(lambda x: str(id(x)))
+        root = PThreadable()
+        parent = PThreadable()
+
+        # Threadables that aren't ThreadableMixins
+        @interface.implementer(IThreadable, IPThreadable)
+        class Other(object):
+            inReplyTo = parent
+            references = (root, parent)
+
+        ext = PInternalObjectIO(Other()).toExternalObject()
+        assert_that(ext, has_entry('inReplyTo', str(id(parent))))
+        assert_that(ext, has_entry('references',
+                                   contains(str(id(root)), str(id(parent)))))
+
+        # And those that read their references their own way
+        class Overridden(PThreadable):
+            @property
+            def references(self):
+                return [root]
+
+        context = Overridden()
+        context.inReplyTo = root
+        context.addReference(parent)
+        ext = PInternalObjectIO(context).toExternalObject()
+        assert_that(ext, has_entry('inReplyTo', str(id(root))))
+        assert_that(ext, has_entry('references', contains(str(id(root)))))
+
     def test_import(self):
         context = PThreadable()
         assert_that(context, has_property('inReplyTo', is_(none())))
@@ -87,3 +131,197 @@ class TestExternalization(unittest.TestCase):
                                       'references': [PThreadable()]})
         assert_that(context, has_property('inReplyTo', is_not(none())))
         assert_that(context, has_property('references', has_length(1)))
+
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_reference_memo(self, mock_oid):
+        calls = []
+
+        def to_oid(obj):
+            calls.append(obj)
+            return str(id(obj))
+        mock_oid.is_callable().calls(to_oid)
+
+        root = PThreadable()
+        root._p_oid = b'root'
+        parent = PThreadable()
+        parent._p_oid = b'parent'
+        transient = PThreadable()
+        contexts = []
+        for _ in range(3):
+            context = PThreadable()
+            context.inReplyTo = parent
+            context.addReference(root)
+            context.addReference(parent)
+            context.addReference(transient)
+            contexts.append(context)
+
+        with external_reference_memo():
+            with external_reference_memo():
+                results = [PInternalObjectIO(c).toExternalObject() for c in contexts]
+        for result in results:
+            assert_that(result,
+                        has_entry('references',
+                                  contains(str(id(root)),
+                                           str(id(parent)),
+                                           str(id(transient)))))
+        # The persistent objects were computed once, the others
+        # every time.
+        assert_that(calls, has_length(5))
+
+        # Outside the memo, every time
+        del calls[:]
+        PInternalObjectIO(contexts[0]).toExternalObject()
+        assert_that(calls, has_length(4))
+
+    @fudge.patch('nti.threadable.externalization.to_external_object')
+    def test_to_external_threadables(self, mock_ext):
+        mock_ext.is_callable().returns({})
+        assert_that(to_external_threadables([PThreadable(), PThreadable()]),
+                    is_([{}, {}]))
+
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_ntiid_cache_skipped(self, mock_oid):
+        calls = []
+
+        def to_oid(obj):
+            calls.append(obj)
+            return str(id(obj))
+        mock_oid.is_callable().calls(to_oid)
+
+        class NoDB(object):
+            pass
+
+        class OtherDB(object):
+            def db(self):
+                return object()
+
+        def check(jar):
+            parent = PThreadable()
+            context = PThreadable()
+            context.inReplyTo = parent
+            parent._p_oid = b'parent'
+            parent._p_jar = jar
+            for _ in range(2):
+                assert_that(PInternalObjectIO(context).toExternalObject(),
+                            has_entry('inReplyTo', str(id(parent))))
+            assert_that(calls, has_length(2))
+            del calls[:]
+            invalidate_external_ntiid(parent, None)
+
+        # Jars that aren't ZODB connections aren't cached
+        check(NoDB())
+        check(OtherDB())
+
+        # Nor is anything without a transaction
+        transaction.manager.explicit = True
+        try:
+            external_ntiid_cache.clear()
+            check(MockJar())
+        finally:
+            transaction.manager.explicit = False
+
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_ntiid_cache(self, mock_oid):
+        calls = []
+
+        def to_oid(obj):
+            calls.append(obj)
+            return str(id(obj))
+        mock_oid.is_callable().calls(to_oid)
+
+        parent = PThreadable()
+        parent._p_oid = b'parent'
+        parent._p_jar = MockJar()
+        context = PThreadable()
+        context.inReplyTo = parent
+
+        external_ntiid_cache.clear()
+        try:
+            for _ in range(3):
+                assert_that(PInternalObjectIO(context).toExternalObject(),
+                            has_entry('inReplyTo', str(id(parent))))
+            assert_that(calls, has_length(1))
+            assert_that(external_ntiid_cache, has_property('hits', 2))
+            assert_that(external_ntiid_cache, has_property('misses', 1))
+            assert_that(external_ntiid_cache.get(parent), is_(str(id(parent))))
+            assert_that(external_ntiid_cache, has_property('hits', 3))
+            repr(external_ntiid_cache)
+
+            # Removing the object forgets it
+            invalidate_external_ntiid(parent, None)
+            PInternalObjectIO(context).toExternalObject()
+            assert_that(calls, has_length(2))
+
+            # As does the end of the transaction
+            transaction.abort()
+            PInternalObjectIO(context).toExternalObject()
+            assert_that(calls, has_length(3))
+
+            # Unless we share between transactions
+            external_ntiid_cache.per_transaction = False
+            PInternalObjectIO(context).toExternalObject()
+            transaction.abort()
+            PInternalObjectIO(context).toExternalObject()
+            assert_that(calls, has_length(4))
+
+            # Caching can be disabled
+            pio = PInternalObjectIO(context)
+            pio._ext_ntiid_cache = None
+            pio.toExternalObject()
+            assert_that(calls, has_length(5))
+        finally:
+            external_ntiid_cache.per_transaction = True
+            external_ntiid_cache.clear()
+            transaction.abort()
+
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_known_oid_not_resolved(self, mock_oid):
+        mock_oid.is_callable().calls(lambda obj: 'ntiid')
+
+        class OidRef(object):
+            oid = b'parent'
+            database_name = 'mock'
+            resolved = 0
+
+            def __init__(self, obj):
+                self.obj = obj
+
+            def __call__(self):
+                self.resolved += 1
+                return self.obj
+
+        parent = PThreadable()
+        parent._p_oid = b'parent'
+        parent._p_jar = MockJar()
+        context = PThreadable()
+        context._inReplyTo = ref = OidRef(parent)
+
+        try:
+            for _ in range(3):
+                assert_that(PInternalObjectIO(context).toExternalObject(),
+                            has_entry('inReplyTo', 'ntiid'))
+            assert_that(ref, has_property('resolved', 1))
+
+            # Once deleted, it is resolved again
+            invalidate_external_ntiid(parent, None)
+            ref.obj = None
+            assert_that(PInternalObjectIO(context).toExternalObject(),
+                        has_entry('inReplyTo', is_(none())))
+            assert_that(ref, has_property('resolved', 2))
+
+            # A reference that was never set is written as None
+            assert_that(PInternalObjectIO(PThreadable()).toExternalObject(),
+                        has_entry('inReplyTo', is_(none())))
+
+            # Subclasses that write references their own way always
+            # get the object
+            class CustomIO(PInternalObjectIO):
+                def _ext_ref(self, obj, ref):
+                    return 'custom:%s' % (obj is parent)
+            ref.obj = parent
+            external_ntiid_cache.set(parent, 'ntiid')
+            assert_that(CustomIO(context).toExternalObject(),
+                        has_entry('inReplyTo', 'custom:True'))
+            assert_that(ref, has_property('resolved', 3))
+        finally:
+            transaction.abort()
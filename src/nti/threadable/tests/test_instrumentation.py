@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import contains
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+from hamcrest import greater_than_or_equal_to
+
+import unittest
+
+from nti.testing.matchers import verifiably_provides
+
+from nti.threadable.instrumentation import Measurement
+from nti.threadable.instrumentation import StatsdRecorder
+
+from nti.threadable.instrumentation import measuring
+from nti.threadable.instrumentation import get_recorder
+from nti.threadable.instrumentation import set_recorder
+from nti.threadable.instrumentation import current_measurement
+
+from nti.threadable.interfaces import IThreadMaintenanceRecorder
+
+from nti.threadable.subscribers import threadable_removed
+
+from nti.threadable.tests import IntIdsLayerTest
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, kind, duration, measurement):
+        self.records.append((kind, duration, measurement))
+
+
+class StatsdClient(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def timing(self, name, value):
+        self.sent.append(('timing', name, value))
+
+    def incr(self, name, count):
+        self.sent.append(('incr', name, count))
+
+
+class TestInstrumentation(IntIdsLayerTest):
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.recorder = Recorder()
+        set_recorder(self.recorder)
+
+    def tearDown(self):
+        set_recorder(None)
+        super(TestInstrumentation, self).tearDown()
+
+    def _last(self, kind):
+        last_kind, duration, measurement = self.recorder.records[-1]
+        assert_that(last_kind, is_(kind))
+        assert_that(duration, is_(greater_than_or_equal_to(0)))
+        return measurement
+
+    def test_recorder(self):
+        assert_that(get_recorder(), is_(self.recorder))
+        assert_that(set_recorder(None), is_(self.recorder))
+        assert_that(current_measurement(), is_(none()))
+        set_recorder(self.recorder)
+        # Only while handling an event
+        assert_that(current_measurement(), is_(none()))
+        repr(Measurement())
+
+    def test_subscribers(self):
+        root = self._create()
+        first = self._create(root)
+        second = self._create(first)
+        assert_that(self.recorder.records, has_length(3))
+        measurement = self._last('added')
+        assert_that(measurement, has_property('ancestors', 2))
+        assert_that(measurement, has_property('sets_created', 2))
+        assert_that(measurement, has_property('sets_mutated', 1))
+        assert_that(measurement, has_property('intids_resolved', 1))
+        assert_that(measurement, has_property('weakrefs_resolved', 0))
+
+        # Walking the pointers
+        first._ancestor_ids = None
+        self._create(first)
+        measurement = self._last('added')
+        assert_that(measurement, has_property('weakrefs_resolved', 2))
+        assert_that(measurement, has_property('intids_resolved', 0))
+        assert_that(measurement, has_property('sets_mutated', 3))
+
+        threadable_removed(second, None)
+        measurement = self._last('removed')
+        assert_that(measurement, has_property('ancestors', 2))
+        assert_that(measurement, has_property('sets_mutated', 3))
+        assert_that(measurement, has_property('intids_resolved', 2))
+
+        # Nothing is measured without a recorder
+        set_recorder(None)
+        self._create(root)
+        assert_that(self.recorder.records, has_length(5))
+
+    def test_failing_recorder(self):
+        class Broken(object):
+            def record(self, *unused_args):
+                raise ValueError()
+        with measuring(Broken(), 'added') as measurement:
+            assert_that(current_measurement(), is_(measurement))
+        assert_that(current_measurement(), is_(none()))
+
+
+class TestStatsdRecorder(unittest.TestCase):
+
+    def test_record(self):
+        client = StatsdClient()
+        recorder = StatsdRecorder(client)
+        assert_that(recorder, verifiably_provides(IThreadMaintenanceRecorder))
+        measurement = Measurement()
+        measurement.ancestors = 3
+        measurement.sets_mutated = 2
+        recorder.record('added', 0.5, measurement)
+        assert_that(client.sent,
+                    contains(('timing', 'nti.threadable.added.duration', 500),
+                             ('timing', 'nti.threadable.added.ancestors', 3),
+                             ('incr', 'nti.threadable.added.sets_mutated', 2)))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
+from hamcrest import assert_that
+from hamcrest import has_property
+from hamcrest import contains_inanyorder
+
+import unittest
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.threadable import subscribers
+
+from nti.threadable.migration import rebuild_thread_indexes
+
+from nti.threadable.tests import MockJar
+from nti.threadable.tests import MockIntIds
+from nti.threadable.tests import PThreadable
+from nti.threadable.tests import SharedConfiguringTestLayer
+from nti.threadable.tests import create_threadable
+
+
+class TestMigration(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def _create(self, intids, parent, createdTime):
+        # The subscribers don't run; building the indexes is up to
+        # the migration
+        return create_threadable(intids, parent, createdTime, added=False)
+
+    def test_rebuild(self):
+        intids = MockIntIds()
+        root = self._create(intids, None, 0)
+        first = self._create(intids, root, 1)
+        nested = self._create(intids, first, 2)
+        second = self._create(intids, root, 3)
+
+        objects = [nested, second, object(), first, root]
+        rebuild_thread_indexes(objects, intids, savepoint_every=2)
+
+        assert_that(list(root._replies),
+                    contains_inanyorder(id(first), id(second)))
+        assert_that(list(root._referents),
+                    contains_inanyorder(id(first), id(second), id(nested)))
+        assert_that(list(first._replies), is_([id(nested)]))
+        assert_that(list(first._referents), is_([id(nested)]))
+        assert_that(root, has_property('replyCount', 2))
+        assert_that(root, has_property('referentCount', 3))
+        assert_that(root._most_recent_reply,
+                    has_property('intid', id(second)))
+        assert_that(root, has_property('_ancestor_ids', is_(())))
+        assert_that(nested,
+                    has_property('_ancestor_ids', is_((id(first), id(root)))))
+        assert_that(nested, has_property('inReplyToId', id(first)))
+        assert_that(nested, has_property('threadRootId', id(root)))
+        assert_that(nested, has_property('threadDepth', 2))
+        assert_that(root, has_property('threadRootId', id(root)))
+        assert_that(root, has_property('threadDepth', 0))
+
+        # Doing it again changes nothing
+        jar = MockJar()
+        for obj in root, first, nested, second:
+            obj._p_jar = jar
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            rebuild_thread_indexes(objects, commit_every=1)
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+        assert_that(root, has_property('replyCount', 2))
+        assert_that(root, has_property('referentCount', 3))
+        # The cache is collected after each commit
+        assert_that(jar, has_property('collected', is_not(0)))
+
+    def test_missing_intids(self):
+        intids = MockIntIds()
+        root = self._create(intids, None, 0)
+        reply = self._create(intids, root, 1)
+        nested = self._create(intids, reply, 2)
+        unregistered = PThreadable()
+
+        def queryId(obj):
+            return None if obj is root or obj is unregistered else id(obj)
+        intids.queryId = queryId
+
+        rebuild_thread_indexes([nested, unregistered], intids)
+        assert_that(nested, has_property('_ancestor_ids', is_(none())))
+        assert_that(nested, has_property('threadDepth', is_(none())))
+        assert_that(reply, has_property('_replies', is_(())))
+        assert_that(unregistered, has_property('_ancestor_ids', is_(none())))
+
+        # An ancestor that can't be resolved is skipped
+        del intids.objects[id(reply)]
+        intids.queryId = id
+        rebuild_thread_indexes([nested], intids)
+        assert_that(nested,
+                    has_property('_ancestor_ids', is_((id(reply), id(root)))))
+        assert_that(list(root._referents), is_([id(nested)]))
+
+    def test_broken_threads(self):
+        intids = MockIntIds()
+        first = self._create(intids, None, 0)
+        second = self._create(intids, first, 1)
+        first.inReplyTo = second
+        reply = self._create(intids, first, 2)
+        rebuild_thread_indexes([reply, first], intids)
+        for obj in reply, first, second:
+            assert_that(obj, has_property('_ancestor_ids', is_(none())))
+
+        root = self._create(intids, None, 0)
+        child = self._create(intids, root, 1)
+        grandchild = self._create(intids, child, 2)
+        old_max = subscribers.MAX_ANCESTOR_DEPTH
+        subscribers.MAX_ANCESTOR_DEPTH = 1
+        try:
+            rebuild_thread_indexes([grandchild, child], intids)
+        finally:
+            subscribers.MAX_ANCESTOR_DEPTH = old_max
+        assert_that(grandchild, has_property('_ancestor_ids', is_(none())))
+        assert_that(child, has_property('_ancestor_ids', is_((id(root),))))
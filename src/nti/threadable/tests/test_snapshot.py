@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from nti.threadable.snapshot import MISSING
+from nti.threadable.snapshot import ThreadSnapshot
+
+from nti.threadable.snapshot import load_thread_snapshot
+from nti.threadable.snapshot import export_thread_snapshot
+
+from nti.threadable.tests import PThreadable
+from nti.threadable.tests import IntIdsLayerTest
+
+
+class TestSnapshot(IntIdsLayerTest):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        super(TestSnapshot, self).tearDown()
+
+    def _thread(self):
+        root = self._create(None, 0)
+        second = self._create(root, 3)
+        first = self._create(root, 1)
+        nested = self._create(first, 2)
+        return root, first, nested, second
+
+    def _id(self, obj):
+        return self.intids.getId(obj)
+
+    def test_round_trip(self):
+        root, first, nested, second = self._thread()
+        objects = [root, first, nested, second, object()]
+        count = export_thread_snapshot(self.path, objects, chunk_size=3)
+        assert_that(count, is_(4))
+        assert_that(sorted(os.listdir(self.path)),
+                    is_(['created.npy', 'depth.npy', 'intid.npy',
+                         'parent.npy', 'root.npy']))
+
+        snapshot = load_thread_snapshot(self.path)
+        assert_that(snapshot, has_length(4))
+        assert_that(snapshot.intid, is_(numpy.memmap))
+        assert_that(snapshot.intid.tolist(),
+                    is_([self._id(x) for x in (root, first, nested, second)]))
+        assert_that(snapshot.parent.tolist(),
+                    is_([MISSING, self._id(root), self._id(first), self._id(root)]))
+        assert_that(snapshot.root.tolist(), is_([self._id(root)] * 4))
+        assert_that(snapshot.depth.tolist(), is_([0, 1, 2, 1]))
+        assert_that(snapshot.created.tolist(), is_([0, 1, 2, 3]))
+        assert_that(snapshot.parentRows.tolist(), is_([MISSING, 0, 1, 0]))
+
+        # Oldest first
+        assert_that(snapshot.replyIds(self._id(root)).tolist(),
+                    is_([self._id(first), self._id(second)]))
+        assert_that(snapshot.replyCount(self._id(root)), is_(2))
+        assert_that(snapshot.replyIds(self._id(first)).tolist(),
+                    is_([self._id(nested)]))
+        assert_that(snapshot.replyCount(self._id(nested)), is_(0))
+        assert_that(snapshot.replyIds(42).tolist(), is_([]))
+        assert_that(snapshot.replyCount(42), is_(0))
+        assert_that(snapshot.rowsOf([self._id(second), 42]).tolist(),
+                    is_([3, MISSING]))
+        repr(snapshot)
+
+        # Loaded into memory
+        snapshot = load_thread_snapshot(self.path, mmap=False)
+        assert_that(snapshot.intid, is_not(numpy.memmap))
+        assert_that(snapshot.replyCount(self._id(root)), is_(2))
+
+    def test_everything_registered(self):
+        root, first, nested, second = self._thread()
+        self.intids.register(object())
+        assert_that(export_thread_snapshot(self.path), is_(4))
+        snapshot = load_thread_snapshot(self.path)
+        assert_that(snapshot.intid.tolist(),
+                    contains_inanyorder(*[self._id(x) for x in (root, first, nested, second)]))
+
+    def test_unknown_values(self):
+        root = self._create(None, 0)
+        # A reply whose parent has no intid and that never got its
+        # thread information.
+        orphan = self.intids.register(PThreadable())
+        orphan.inReplyTo = PThreadable()
+        orphan._inReplyToId = None
+        orphan.createdTime = 1
+        export_thread_snapshot(self.path, [root, orphan],
+                               intids=_NoParents(self.intids))
+        snapshot = load_thread_snapshot(self.path)
+        assert_that(snapshot.parent.tolist(), is_([MISSING, MISSING]))
+        assert_that(snapshot.root.tolist(), is_([self._id(root), MISSING]))
+        assert_that(snapshot.depth.tolist(), is_([0, MISSING]))
+
+    def test_empty(self):
+        # The directory is created if needed
+        path = os.path.join(self.path, 'new', 'snapshot')
+        assert_that(export_thread_snapshot(path, ()), is_(0))
+        snapshot = load_thread_snapshot(path)
+        assert_that(snapshot, has_length(0))
+        assert_that(snapshot.replyIds(1).tolist(), is_([]))
+        assert_that(snapshot.rowsOf([1]).tolist(), is_([MISSING]))
+
+    def test_failure_keeps_previous(self):
+        root = self._create(None, 0)
+        export_thread_snapshot(self.path, [root])
+
+        def broken():
+            yield root
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            export_thread_snapshot(self.path, broken())
+        assert_that(sorted(os.listdir(self.path)), has_length(5))
+        assert_that(load_thread_snapshot(self.path), has_length(1))
+
+    def test_mismatched_columns(self):
+        with self.assertRaises(ValueError):
+            ThreadSnapshot(numpy.arange(2), numpy.arange(2), numpy.arange(2),
+                           numpy.arange(2), numpy.arange(3))
+
+
+class _NoParents(object):
+
+    def __init__(self, intids):
+        self.intids = intids
+
+    def queryId(self, obj):
+        if obj in self.intids.objects.values():
+            return self.intids.getId(obj)
+        return None
@@ -7,14 +7,15 @@ from __future__ import absolute_import
 
 # pylint: disable=protected-access,too-many-public-methods
 
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import is_not
 from hamcrest import has_length
 from hamcrest import assert_that
 from hamcrest import has_property
 
 import unittest
 
-import BTrees
-
 from zope import component
 from zope import interface
 
@@ -22,17 +23,31 @@ from zope.intid.interfaces import IIntIds
 
 from persistent import Persistent
 
+from nti.threadable.cache import ancestor_chain_cache
+
+from nti.threadable.datastructures import ShardedTreeSet
+
+from nti.threadable import subscribers
+
 from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import ThreadCycleError
+from nti.threadable.interfaces import ThreadTooDeepError
+from nti.threadable.interfaces import IThreadWalkAbortedEvent
 
 from nti.threadable.subscribers import discard
 
 from nti.threadable.subscribers import threadable_added
 from nti.threadable.subscribers import _do_threadable_added
 
+from nti.threadable.subscribers import removing_subtree
+from nti.threadable.subscribers import invalidate_ancestor_chain
 from nti.threadable.subscribers import threadable_removed
 
+from nti.threadable.tests import MockIntIds
 from nti.threadable.tests import PThreadable
+from nti.threadable.tests import TimeIndexed
 from nti.threadable.tests import SharedConfiguringTestLayer
+from nti.threadable.tests import create_threadable
 
 
 class TestSubscribers(unittest.TestCase):
@@ -41,17 +56,11 @@ class TestSubscribers(unittest.TestCase):
 
     def test_discard(self):
         # coverage
-        discard([1], 1)
-        discard([1], 2)
+        assert_that(discard([1], 1), is_(True))
+        assert_that(discard([1], 2), is_(False))
+        assert_that(discard(set([1]), 1), is_(True))
 
     def test_threadable_added(self):
-
-        class MockIntIds(object):
-            family = BTrees.family64
-
-            def getId(self, obj):
-                return id(obj)
-
         intids = MockIntIds()
         component.getGlobalSiteManager().registerUtility(intids, IIntIds)
 
@@ -76,8 +85,22 @@ class TestSubscribers(unittest.TestCase):
         assert_that(inReplyTo,
                     has_property('_referents', has_length(1)))
 
+        assert_that(inReplyTo,
+                    has_property('replyCount', 1))
+        assert_that(inReplyTo,
+                    has_property('referentCount', 1))
+
+        # added again is a no-op for the counts
+        threadable_added(context, None)
+        assert_that(inReplyTo,
+                    has_property('replyCount', 1))
+
         # removed
         threadable_removed(context, None)
+        assert_that(inReplyTo,
+                    has_property('replyCount', 0))
+        assert_that(inReplyTo,
+                    has_property('referentCount', 0))
 
         # coverage
         @interface.implementer(IThreadable)
@@ -87,3 +110,375 @@ class TestSubscribers(unittest.TestCase):
         context.inReplyTo = inReplyTo
         threadable_removed(context, None)
         component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
+
+    def test_most_recent_reply(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            parent = intids.register(PThreadable())
+            first = create_threadable(intids, parent, 1)
+            assert_that(parent, has_property('mostRecentReply', is_(first)))
+
+            second = create_threadable(intids, parent, 2)
+            older = create_threadable(intids, parent, 0)
+            assert_that(parent._most_recent_reply,
+                        has_property('intid', id(second)))
+            assert_that(parent, has_property('mostRecentReply', is_(second)))
+
+            # Removing something else doesn't change it
+            threadable_removed(older, None)
+            assert_that(parent, has_property('mostRecentReply', is_(second)))
+
+            # Removing the newest falls back to the next
+            threadable_removed(second, None)
+            assert_that(parent._most_recent_reply,
+                        has_property('intid', id(first)))
+
+            threadable_removed(first, None)
+            assert_that(parent._most_recent_reply,
+                        has_property('intid', is_(none())))
+            assert_that(parent, has_property('mostRecentReply', is_(none())))
+
+            # Replies from before the pointer was maintained are
+            # taken into account.
+            legacy = intids.register(PThreadable())
+            legacy.createdTime = 10
+            parent._most_recent_reply = None
+            parent._replies.add(id(legacy))
+            create_threadable(intids, parent, 5)
+            assert_that(parent, has_property('mostRecentReply', is_(legacy)))
+
+            # Replies that are gone are skipped
+            parent._replies.add(42)
+            legacy.inReplyTo = parent
+            threadable_removed(legacy, None)
+            assert_that(parent._most_recent_reply,
+                        has_property('createdTime', 5))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_time_index(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            for factory in TimeIndexed, PThreadable:
+                root = intids.register(factory())
+                parent = intids.register(factory())
+                parent.inReplyTo = root
+                threadable_added(parent, None)
+                # Out of order creation times
+                replies = {}
+                for created in (3, 1, 4, 2, 0):
+                    replies[created] = create_threadable(intids, parent, created)
+
+                assert_that(list(parent.iterReplies(limit=2)),
+                            is_([replies[4], replies[3]]))
+                assert_that(list(parent.iterReplies(start=2, limit=2)),
+                            is_([replies[2], replies[1]]))
+                assert_that(list(parent.iterReplies(start=4, limit=2)),
+                            is_([replies[0]]))
+                assert_that(list(parent.iterReplies(reverse=False, start=1, limit=3)),
+                            is_([replies[1], replies[2], replies[3]]))
+                assert_that(list(parent.iterReplies(start=10)),
+                            is_([]))
+                assert_that(list(parent.iterReplies(sort=None)),
+                            has_length(5))
+                assert_that(list(parent.iterReplies(sort=None, reverse=True, limit=1)),
+                            has_length(1))
+                assert_that(list(root.iterReferents(limit=1)),
+                            is_([replies[4]]))
+
+                threadable_removed(replies[4], None)
+                assert_that(list(parent.iterReplies(limit=1)),
+                            is_([replies[3]]))
+                assert_that(list(root.iterReferents(limit=1)),
+                            is_([replies[3]]))
+
+                if factory is TimeIndexed:
+                    # Unresolvable objects are skipped
+                    del intids.objects[id(replies[3])]
+                    assert_that(list(parent.iterReplies(limit=2)),
+                                is_([replies[2]]))
+
+            with self.assertRaises(ValueError):
+                parent.iterReplies(sort='bogus')
+            assert_that(list(PThreadable().iterReplies()),
+                        is_([]))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_time_index_seeded(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            root = intids.register(PThreadable())
+            parent = create_threadable(intids, root, 0)
+            replies = [create_threadable(intids, parent, created)
+                       for created in (4, 2, 5, 3, 6, 1)]
+            # Replies from before the index was kept
+            parent._maintain_time_index = root._maintain_time_index = True
+            assert_that(list(parent.iterReplies()), has_length(6))
+
+            newest = create_threadable(intids, parent, 7)
+            assert_that(list(parent.iterReplies()),
+                        is_([newest] + sorted(replies, key=lambda x: -x.createdTime)))
+            assert_that(list(parent._replies_by_time), has_length(7))
+            assert_that(list(root.iterReferents(reverse=False, limit=3)),
+                        is_([parent, replies[-1], replies[1]]))
+            assert_that(list(root._referents_by_time), has_length(8))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_ancestor_chain(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            root = intids.register(PThreadable())
+            threadable_added(root, None)
+            assert_that(root, has_property('_ancestor_ids', is_(())))
+
+            first = create_threadable(intids, root, 1)
+            second = create_threadable(intids, first, 2)
+            third = create_threadable(intids, second, 3)
+            assert_that(third,
+                        has_property('_ancestor_ids',
+                                     is_((id(second), id(first), id(root)))))
+            assert_that(third, has_property('inReplyToId', id(second)))
+            assert_that(root, has_property('threadRootId', id(root)))
+            assert_that(root, has_property('threadDepth', 0))
+            assert_that(third, has_property('threadRootId', id(root)))
+            assert_that(third, has_property('threadDepth', 3))
+            for ancestor in root, first, second:
+                assert_that(id(third) in ancestor._referents, is_(True))
+
+            # A parent without a chain (e.g., from before we stored them)
+            # falls back to walking the pointers.
+            second._ancestor_ids = None
+            fourth = create_threadable(intids, second, 4)
+            assert_that(fourth,
+                        has_property('_ancestor_ids',
+                                     is_((id(second), id(first), id(root)))))
+            assert_that(fourth, has_property('threadDepth', 3))
+
+            # A parent without a position (also from before) gets
+            # it from the chain.
+            second._threadRootId = second._threadDepth = None
+            fourth = create_threadable(intids, second, 4)
+            assert_that(fourth, has_property('threadRootId', id(root)))
+            assert_that(fourth, has_property('threadDepth', 3))
+
+            # As does a chain that can't be resolved.
+            del intids.objects[id(first)]
+            fifth = create_threadable(intids, third, 5)
+            assert_that(fifth,
+                        has_property('_ancestor_ids',
+                                     is_((id(third), id(second), id(first), id(root)))))
+            assert_that(id(fifth) in root._referents, is_(True))
+
+            threadable_removed(fifth, None)
+            assert_that(id(fifth) in root._referents, is_(False))
+            assert_that(id(fifth) in first._referents, is_(False))
+
+            # The same when removing with a good chain
+            intids.register(first)
+            threadable_removed(fourth, None)
+            for ancestor in root, first, second:
+                assert_that(id(fourth) in ancestor._referents, is_(False))
+
+            # An ancestor that can't be given an intid means no chain
+            intids.queryId = lambda unused_obj: None
+            sixth = create_threadable(intids, third, 6)
+            assert_that(sixth, has_property('_ancestor_ids', is_(none())))
+            assert_that(sixth, has_property('inReplyToId', is_(none())))
+            # (the parent still knows its position)
+            assert_that(sixth, has_property('threadDepth', 4))
+            third._threadDepth = None
+            seventh = create_threadable(intids, third, 7)
+            assert_that(seventh, has_property('threadRootId', is_(none())))
+            assert_that(seventh, has_property('threadDepth', is_(none())))
+            assert_that(id(sixth) in root._referents, is_(True))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_removing_subtree(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            top = intids.register(PThreadable())
+            threadable_added(top, None)
+            sibling = create_threadable(intids, top, 1)
+            root = create_threadable(intids, top, 2)
+            child = create_threadable(intids, root, 3)
+            grandchild = create_threadable(intids, child, 4)
+            subtree = (root, child, grandchild)
+
+            # Nothing happens if the block fails
+            with self.assertRaises(KeyError):
+                with removing_subtree(root):
+                    threadable_removed(grandchild, None)
+                    raise KeyError()
+            assert_that(top, has_property('referentCount', 4))
+
+            with removing_subtree(root) as removal:
+                for obj in reversed(subtree):
+                    threadable_removed(obj, None)
+                # Unrelated objects are handled as usual
+                unrelated = create_threadable(intids, sibling, 5)
+                threadable_removed(unrelated, None)
+                assert_that(removal.removed, has_length(3))
+                # Nothing has happened yet
+                assert_that(top, has_property('referentCount', 4))
+                assert_that(sibling, has_property('referentCount', 0))
+
+            assert_that(list(top._replies), is_([id(sibling)]))
+            assert_that(list(top._referents), is_([id(sibling)]))
+            assert_that(top, has_property('replyCount', 1))
+            assert_that(top, has_property('referentCount', 1))
+            assert_that(top, has_property('mostRecentReply', is_(sibling)))
+
+            # Removing only the descendants of a root that survives
+            root = create_threadable(intids, top, 6)
+            child = create_threadable(intids, root, 7)
+            with removing_subtree(root):
+                threadable_removed(child, None)
+            assert_that(root, has_property('referentCount', 0))
+            assert_that(root, has_property('replyCount', 0))
+            assert_that(list(root._replies), is_([]))
+            assert_that(root, has_property('mostRecentReply', is_(none())))
+            assert_that(top, has_property('referentCount', 2))
+
+            # Only the direct replies leave the replies of the root
+            older = create_threadable(intids, root, 8)
+            newer = create_threadable(intids, root, 9)
+            nested = create_threadable(intids, older, 10)
+            # From before the intid of the parent was kept
+            newer._inReplyToId = None
+            with removing_subtree(root):
+                threadable_removed(newer, None)
+                threadable_removed(nested, None)
+            assert_that(list(root._replies), is_([id(older)]))
+            assert_that(root, has_property('replyCount', 1))
+            assert_that(root, has_property('mostRecentReply', is_(older)))
+            assert_that(list(root._referents), is_([id(older)]))
+            assert_that(root, has_property('referentCount', 1))
+            assert_that(top, has_property('referentCount', 3))
+
+            # Removing nothing, or a top-level object
+            with removing_subtree(root):
+                pass
+            with removing_subtree(top):
+                threadable_removed(top, None)
+            assert_that(top, has_property('referentCount', 3))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_sharded_referents(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        try:
+            root = intids.register(PThreadable())
+            root._referents_shards = 4
+            threadable_added(root, None)
+            first = create_threadable(intids, root, 1)
+            second = create_threadable(intids, first, 2)
+            assert_that(root._referents, is_(ShardedTreeSet))
+            assert_that(first._referents, is_not(ShardedTreeSet))
+            assert_that(list(root._referents), is_(sorted([id(first), id(second)])))
+            assert_that(root, has_property('referentCount', 2))
+
+            threadable_removed(second, None)
+            assert_that(list(root._referents), is_([id(first)]))
+            assert_that(root, has_property('referentCount', 1))
+        finally:
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_broken_threads(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        events = []
+        gsm.registerHandler(events.append, (IThreadWalkAbortedEvent,))
+        try:
+            # A cycle in the pointers
+            first = intids.register(PThreadable())
+            second = intids.register(PThreadable())
+            first.inReplyTo = second
+            second.inReplyTo = first
+            reply = intids.register(PThreadable())
+            reply.inReplyTo = first
+            with self.assertRaises(ThreadCycleError) as exc:
+                threadable_added(reply, None)
+            assert_that(exc.exception,
+                        has_property('ancestors', is_([first, second])))
+            assert_that(events, has_length(1))
+            assert_that(events[0], has_property('object', first))
+            assert_that(events[0], has_property('error', exc.exception))
+            # It can still be removed
+            threadable_removed(reply, None)
+            assert_that(events, has_length(2))
+
+            # A cycle in a stored chain
+            root = intids.register(PThreadable())
+            threadable_added(root, None)
+            child = create_threadable(intids, root, 1)
+            child._ancestor_ids = (id(child),)
+            with self.assertRaises(ThreadCycleError):
+                create_threadable(intids, child, 2)
+
+            # Too deep
+            child._ancestor_ids = (id(root),)
+            grandchild = create_threadable(intids, child, 2)
+            old_max = subscribers.MAX_ANCESTOR_DEPTH
+            subscribers.MAX_ANCESTOR_DEPTH = 2
+            try:
+                with self.assertRaises(ThreadTooDeepError):
+                    create_threadable(intids, grandchild, 3)
+                grandchild._ancestor_ids = None
+                with self.assertRaises(ThreadTooDeepError) as exc:
+                    create_threadable(intids, grandchild, 3)
+                assert_that(exc.exception,
+                            has_property('ancestors', has_length(3)))
+            finally:
+                subscribers.MAX_ANCESTOR_DEPTH = old_max
+            assert_that(events, has_length(5))
+        finally:
+            gsm.unregisterHandler(events.append, (IThreadWalkAbortedEvent,))
+            gsm.unregisterUtility(intids, IIntIds)
+
+    def test_ancestor_chain_cache(self):
+        intids = MockIntIds()
+        gsm = component.getGlobalSiteManager()
+        gsm.registerUtility(intids, IIntIds)
+        ancestor_chain_cache.clear()
+        try:
+            root = intids.register(PThreadable())
+            threadable_added(root, None)
+            first = create_threadable(intids, root, 1)
+            # An object from before we stored chains
+            first._ancestor_ids = None
+            first._p_oid = b'first'
+
+            second = create_threadable(intids, first, 2)
+            assert_that(ancestor_chain_cache, has_length(1))
+            assert_that(ancestor_chain_cache.get(id(first), first),
+                        is_((id(root),)))
+
+            # Now the walk isn't needed
+            first._inReplyTo = None  # The walk would stop here
+            third = create_threadable(intids, first, 3)
+            assert_that(third,
+                        has_property('_ancestor_ids', is_((id(first), id(root)))))
+
+            invalidate_ancestor_chain(second, None)
+            assert_that(ancestor_chain_cache, has_length(1))
+            invalidate_ancestor_chain(first, None)
+            assert_that(ancestor_chain_cache, has_length(0))
+        finally:
+            ancestor_chain_cache.clear()
+            gsm.unregisterUtility(intids, IIntIds)
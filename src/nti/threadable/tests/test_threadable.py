@@ -9,7 +9,9 @@ from __future__ import absolute_import
 
 from hamcrest import is_
 from hamcrest import none
+from hamcrest import is_not
 from hamcrest import assert_that
+from hamcrest import contains_string
 from hamcrest import has_property
 
 from nti.testing.matchers import validly_provides
@@ -17,17 +19,38 @@ from nti.testing.matchers import verifiably_provides
 
 import unittest
 
+from BTrees.Length import Length
+
 from zope import component
+from zope import interface
 
 from zope.intid.interfaces import IIntIds
 
 from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import IMaintainedThreadable
+
+from nti.threadable.datastructures import MostRecentReply
 
 from nti.threadable.threadable import Threadable
+from nti.threadable.threadable import _IntidWeakRef
+from nti.threadable.threadable import PrefetchingIntidResolvingIterable
+
+from nti.threadable.threadable import prefetch
+
+from nti.threadable.tests import MockJar
+from nti.threadable.tests import MockIntIds
+from nti.threadable.tests import PThreadable
 
 from nti.threadable.tests import SharedConfiguringTestLayer
 
 
+class Ghost(object):
+
+    def __init__(self, jar, changed=None):
+        self._p_jar = jar
+        self._p_changed = changed
+
+
 class TestThreadable(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -36,6 +59,8 @@ class TestThreadable(unittest.TestCase):
         threadable = Threadable()
         assert_that(threadable, validly_provides(IThreadable))
         assert_that(threadable, verifiably_provides(IThreadable))
+        assert_that(threadable, validly_provides(IMaintainedThreadable))
+        assert_that(threadable, verifiably_provides(IMaintainedThreadable))
         
         assert_that(threadable.isOrWasChildInThread(),
                     is_(False))
@@ -49,11 +74,19 @@ class TestThreadable(unittest.TestCase):
         assert_that(threadable,
                     has_property('most_recent_reply', is_(none())))
 
-        
+        assert_that(threadable,
+                    has_property('replyCount', is_(0)))
+
+        assert_that(threadable,
+                    has_property('referentCount', is_(0)))
+
         mock = Threadable()
         class MockIntIds(object):
             def getObject(self, unused_doc_id):
                 return mock
+
+            def queryObject(self, doc_id, default=None):
+                return mock if doc_id == 1 else default
             
         intids = MockIntIds()
         component.getGlobalSiteManager().registerUtility(intids, IIntIds)
@@ -61,12 +94,170 @@ class TestThreadable(unittest.TestCase):
         
         assert_that(list(threadable.replies),
                     is_([mock]))
+
+        # Without prefetching, too
+        threadable._prefetch_chunk_size = 0
+        assert_that(list(threadable.replies),
+                    is_([mock]))
+        del threadable._prefetch_chunk_size
         
         assert_that(threadable,
                     has_property('most_recent_reply', is_(mock)))
          
+        assert_that(threadable,
+                    has_property('replyCount', is_(1)))
+
+        # A maintained pointer
+        threadable._most_recent_reply = MostRecentReply(1, 42)
+        assert_that(threadable,
+                    has_property('most_recent_reply', is_(mock)))
+
+        # A stale pointer falls back to the replies
+        threadable._most_recent_reply = MostRecentReply(2, 42)
+        assert_that(threadable,
+                    has_property('most_recent_reply', is_(mock)))
+
+        # No replies anymore
+        threadable._most_recent_reply = MostRecentReply()
+        assert_that(threadable,
+                    has_property('most_recent_reply', is_(none())))
+        del threadable._most_recent_reply
+
         threadable._referents = [1]
         assert_that(list(threadable.referents),
                     is_([mock]))
+
+        assert_that(threadable,
+                    has_property('referentCount', is_(1)))
+
+        threadable._referent_count = Length(5)
+        assert_that(threadable,
+                    has_property('referentCount', is_(5)))
         
         component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
+
+    def test_other_implementations(self):
+        # The maintained attributes aren't required of every threadable
+        @interface.implementer(IThreadable)
+        class Minimal(object):
+            inReplyTo = None
+            references = ()
+            replies = ()
+            referents = ()
+        assert_that(Minimal(), verifiably_provides(IThreadable))
+
+    def test_compact_references(self):
+
+        class CompactThreadable(Threadable):
+            _compact_references = True
+
+        intids = MockIntIds()
+        threadable = CompactThreadable()
+        root = intids.register(PThreadable())
+        parent = intids.register(PThreadable())
+        no_intid = PThreadable()
+
+        # Without an intid utility, we store weak refs
+        threadable.addReference(root)
+        assert_that(threadable, has_property('references', is_([root])))
+        threadable.clearReferences()
+        assert_that(threadable, has_property('references', is_(())))
+
+        component.getGlobalSiteManager().registerUtility(intids, IIntIds)
+        try:
+            intids.queryId = lambda obj: None if obj is no_intid else id(obj)
+            threadable.addReference(None)
+            for ref in (root, parent, no_intid):
+                threadable.addReference(ref)
+            assert_that(threadable, has_property('_references', is_(())))
+            assert_that(threadable._reference_ids[:2],
+                        is_((id(root), id(parent))))
+            assert_that(threadable.isOrWasChildInThread(), is_(True))
+            assert_that(threadable,
+                        has_property('references', is_([root, parent, no_intid])))
+
+            # Missing objects are skipped
+            del intids.objects[id(parent)]
+            assert_that(threadable,
+                        has_property('references', is_([root, no_intid])))
+
+            refs = threadable._reference_refs()
+            assert_that(refs[1], is_(_IntidWeakRef(id(parent))))
+            assert_that(refs[0] != refs[1], is_(True))
+            assert_that(hash(refs[1]), is_(hash(id(parent))))
+            assert_that(refs[1].make_missing_ntiid(),
+                        contains_string('Missing'))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
+        assert_that(refs[0](), is_(none()))
+
+        threadable.clearReferences()
+        assert_that(threadable, has_property('references', is_(())))
+        assert_that(threadable.isOrWasChildInThread(), is_(False))
+
+    def test_in_reply_to_id(self):
+        parent = PThreadable()
+        threadable = PThreadable()
+        threadable.inReplyTo = parent
+        assert_that(threadable, has_property('inReplyToId', is_(none())))
+
+        intids = MockIntIds()
+        intids.register(parent)
+        component.getGlobalSiteManager().registerUtility(intids, IIntIds)
+        try:
+            threadable.inReplyTo = parent
+            assert_that(threadable, has_property('inReplyToId', id(parent)))
+            threadable.inReplyTo = None
+            assert_that(threadable, has_property('inReplyToId', is_(none())))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
+
+    def test_thread_position(self):
+        threadable = Threadable()
+        assert_that(threadable, has_property('threadRootId', is_(none())))
+        assert_that(threadable, has_property('threadDepth', is_(none())))
+        threadable._threadRootId = 42
+        threadable._threadDepth = 1
+        assert_that(threadable, has_property('thread_root_id', 42))
+        assert_that(threadable, has_property('thread_depth', 1))
+
+    def test_prefetch(self):
+        jar = MockJar()
+        other_jar = MockJar()
+        ghosts = [Ghost(jar), Ghost(other_jar), Ghost(jar)]
+        prefetch(ghosts + [Ghost(jar, False), object(), Ghost(None)])
+        assert_that(jar.prefetched, is_([[ghosts[0], ghosts[2]]]))
+        assert_that(other_jar.prefetched, is_([[ghosts[1]]]))
+
+    def test_chunked_replies(self):
+        intids = MockIntIds()
+        jar = MockJar()
+        ghosts = [intids.register(Ghost(jar)) for _ in range(5)]
+        doc_ids = [id(x) for x in ghosts]
+        component.getGlobalSiteManager().registerUtility(intids, IIntIds)
+        try:
+            class Chunked(Threadable):
+                _prefetch_chunk_size = 2
+
+            threadable = Chunked()
+            threadable._replies = doc_ids + [42]
+            replies = threadable.replies
+            assert_that(replies, is_(PrefetchingIntidResolvingIterable))
+            assert_that(list(replies), is_(ghosts))
+            assert_that([len(x) for x in jar.prefetched], is_([2, 2, 1]))
+            with self.assertRaises(KeyError):
+                list(replies.__iter__(allow_missing=False))
+
+            del jar.prefetched[:]
+            assert_that(list(threadable.iterReplies(sort=None, reverse=False)),
+                        is_(ghosts))
+            assert_that([len(x) for x in jar.prefetched], is_([2, 2, 1]))
+
+            # Turned off
+            threadable._prefetch_chunk_size = 0
+            assert_that(threadable.replies,
+                        is_not(PrefetchingIntidResolvingIterable))
+            assert_that(list(threadable.iterReplies(sort=None, reverse=False)),
+                        is_(ghosts))
+        finally:
+            component.getGlobalSiteManager().unregisterUtility(intids, IIntIds)
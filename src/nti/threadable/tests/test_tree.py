@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+# pylint: disable=protected-access,too-many-public-methods
+
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import contains
+from hamcrest import has_entry
+from hamcrest import has_length
+from hamcrest import assert_that
+from hamcrest import has_property
+
+import fudge
+
+from nti.threadable.externalization import external_reference_memo
+
+from nti.threadable.tree import ThreadNode
+from nti.threadable.tree import ThreadNodeView
+
+from nti.threadable.tree import build_thread_tree
+from nti.threadable.tree import thread_node_views
+
+from nti.threadable.tests import PThreadable
+from nti.threadable.tests import TimeIndexed
+from nti.threadable.tests import IntIdsLayerTest
+
+
+class TestTree(IntIdsLayerTest):
+
+    factory = TimeIndexed
+
+    def _thread(self, factory=TimeIndexed):
+        root = self._create(None, 0, factory)
+        first = self._create(root, 1, factory)
+        nested = self._create(first, 2, factory)
+        second = self._create(root, 3, factory)
+        deepest = self._create(nested, 4, factory)
+        return root, first, nested, second, deepest
+
+    def test_build(self):
+        root, first, nested, second, deepest = self._thread(PThreadable)
+        tree = build_thread_tree(root)
+        assert_that(tree, has_property('object', is_(root)))
+        assert_that([x.object for x in tree.children], is_([first, second]))
+        assert_that([x.object for x in tree],
+                    is_([root, first, nested, deepest, second]))
+        assert_that([x.depth for x in tree], is_([0, 1, 2, 3, 1]))
+        repr(tree)
+
+        tree = build_thread_tree(root, max_depth=2)
+        assert_that([x.object for x in tree],
+                    is_([root, first, nested, second]))
+
+        # Without the ancestor chains
+        for obj in first, nested, second, deepest:
+            obj._ancestor_ids = None
+        tree = build_thread_tree(root, max_depth=1)
+        assert_that([x.object for x in tree],
+                    is_([root, first, second]))
+
+        # Missing objects, and their descendants, are left out
+        del self.intids.objects[id(nested)]
+        tree = build_thread_tree(root)
+        assert_that([x.object for x in tree],
+                    is_([root, first, second]))
+
+    def test_max_nodes(self):
+        root, first, nested, _, _ = self._thread()
+        tree = build_thread_tree(root, max_nodes=2)
+        assert_that([x.object for x in tree],
+                    is_([root, first, nested]))
+
+    @fudge.patch('nti.threadable.tree.to_external_object')
+    def test_externalize(self, mock_ext):
+        mock_ext.is_callable().calls(lambda obj: {'createdTime': obj.createdTime})
+        root = self._thread()[0]
+        ext = build_thread_tree(root, max_depth=1).toExternalObject()
+        assert_that(ext, has_entry('Item', {'createdTime': 0}))
+        assert_that(ext, has_entry('Children', has_length(2)))
+        assert_that(ext['Children'][0],
+                    has_entry('Children', is_([])))
+
+    @fudge.patch('nti.threadable.tree.to_external_object')
+    def test_deep_chain(self, mock_ext):
+        mock_ext.is_callable().calls(lambda obj: obj)
+        depth = 5000
+        top = node = ThreadNode(0, 0)
+        for i in range(1, depth + 1):
+            child = ThreadNode(i, i, i)
+            node.children.append(child)
+            node = child
+        assert_that([x.intid for x in top], is_(list(range(depth + 1))))
+
+        ext = top.toExternalObject()
+        for i in range(depth + 1):
+            assert_that(ext, has_entry('Item', i))
+            children = ext['Children']
+            ext = children[0] if children else None
+        assert_that(ext, is_(None))
+
+    @fudge.patch('nti.threadable.externalization.to_external_ntiid_oid')
+    def test_views(self, mock_oid):
+        mock_oid.is_callable().calls(lambda x: 'tag:%s' % id(x))
+        root, first, nested, second, unused_deepest = self._thread()
+        views = thread_node_views([root, first, nested, second],
+                                  deactivate=True)
+        assert_that(views, contains(
+            ThreadNodeView(id(root), None, 0, 2, 'tag:%s' % id(root)),
+            ThreadNodeView(id(first), id(root), 1, 1, 'tag:%s' % id(first)),
+            ThreadNodeView(id(nested), id(first), 2, 1, 'tag:%s' % id(nested)),
+            ThreadNodeView(id(second), id(root), 3, 0, 'tag:%s' % id(second)),
+        ))
+        view = views[1]
+        assert_that(view, is_not(views[2]))
+        assert_that(view != views[2], is_(True))
+        assert_that(view != views[1], is_(False))
+        assert_that(view == root, is_(False))
+        assert_that(view != root, is_(True))
+        assert_that(view.toExternalObject(),
+                    has_entry('ParentIntId', id(root)))
+        assert_that(ThreadNodeView.from_threadable(first), is_(view))
+
+        # Within a memo, the NTIID is only computed once
+        first._p_oid = b'first'
+        mock_oid.is_callable().returns('tag:first')
+        with external_reference_memo():
+            ThreadNodeView.from_threadable(first)
+            mock_oid.is_callable().raises(AssertionError)
+            assert_that(ThreadNodeView.from_threadable(first),
+                        has_property('ntiid', 'tag:first'))
+        repr(view)
+        with self.assertRaises(AttributeError):
+            view.object = first  # pylint: disable=assigning-non-slot
@@ -10,20 +10,171 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+from itertools import islice
+
+from numbers import Integral
+
+from zope import component
 from zope import interface
 
+from zope.intid.interfaces import IIntIds
+
 from persistent.list import PersistentList
 
 from nti.containers.datastructures import IntidResolvingIterable
 
+from nti.ntiids.ntiids import TYPE_MISSING
+
+from nti.ntiids.ntiids import make_ntiid
+
+from nti.threadable.interfaces import IThreadable
+from nti.threadable.interfaces import IMaintainedThreadable
 from nti.threadable.interfaces import IInspectableWeakThreadable
 
 from nti.wref.interfaces import IWeakRef
+from nti.wref.interfaces import IWeakRefToMissing
 
 logger = __import__('logging').getLogger(__name__)
 
 
-@interface.implementer(IInspectableWeakThreadable)
+def _created_time(obj):
+    return getattr(obj, 'createdTime', 0) or 0
+
+
+def _query_id(obj):
+    intids = component.queryUtility(IIntIds)
+    return intids.queryId(obj) if intids is not None else None
+
+
+def _threadables(objects, intids):
+    """
+    The ``(intid, threadable)`` pairs of the threadables in *objects*,
+    skipping other objects and those without intids. If *objects* is
+    None, every threadable registered with *intids*.
+    """
+    if objects is None:
+        # Everything with an intid
+        for doc_id in intids:
+            obj = intids.queryObject(doc_id)
+            if IThreadable.providedBy(obj):
+                yield doc_id, obj
+        return
+    for obj in objects:
+        if IThreadable.providedBy(obj):
+            doc_id = intids.queryId(obj)
+            if doc_id is not None:
+                yield doc_id, obj
+
+
+def _window(keys, start, limit, reverse):
+    """
+    Slice the sequence *keys* (a list or lazy BTree keys) for a page.
+    Only the keys in the page are materialized.
+    """
+    if reverse:
+        stop = max(len(keys) - start, 0)
+        begin = 0 if limit is None else max(stop - limit, 0)
+        return reversed(list(keys[begin:stop]))
+    stop = None if limit is None else start + limit
+    return keys[start:stop]
+
+
+def prefetch(objects):
+    """
+    Ask the connection of each ghost among *objects* to prefetch its
+    state, with one request per connection. With storages that support
+    it (such as ZEO and RelStorage), the objects can then be activated
+    without a round trip each.
+    """
+    by_jar = {}
+    for obj in objects:
+        if getattr(obj, '_p_changed', False) is None:  # A ghost
+            jar = obj._p_jar
+            by_jar.setdefault(id(jar), (jar, []))[1].append(obj)
+    for jar, ghosts in by_jar.values():
+        fetch = getattr(jar, 'prefetch', None)
+        if fetch is not None:
+            fetch(ghosts)
+
+
+def _resolve_in_chunks(doc_ids, intids, chunk_size, allow_missing=True):
+    """
+    Resolve the intids in *doc_ids* *chunk_size* at a time, prefetching
+    each chunk of objects before any of them is returned.
+    """
+    doc_ids = iter(doc_ids)
+    while True:
+        chunk = list(islice(doc_ids, chunk_size))
+        if not chunk:
+            break
+        objects = []
+        for doc_id in chunk:
+            obj = intids.queryObject(doc_id)
+            if obj is not None:
+                objects.append(obj)
+            elif not allow_missing:
+                raise KeyError(doc_id)
+        prefetch(objects)
+        for obj in objects:
+            yield obj
+
+
+class PrefetchingIntidResolvingIterable(IntidResolvingIterable):
+    """
+    An :class:`~nti.containers.datastructures.IntidResolvingIterable`
+    that resolves its intids in chunks of *chunk_size*, prefetching
+    the objects of each chunk (see :func:`prefetch`).
+    """
+
+    def __init__(self, ids, allow_missing=False, parent=None, name=None,
+                 chunk_size=100):
+        super(PrefetchingIntidResolvingIterable, self).__init__(ids,
+                                                                allow_missing=allow_missing,
+                                                                parent=parent,
+                                                                name=name)
+        self._chunked_ids = ids
+        self._chunked_allow_missing = allow_missing
+        self.chunk_size = chunk_size
+
+    def __iter__(self, allow_missing=None):
+        if allow_missing is None:
+            allow_missing = self._chunked_allow_missing
+        intids = component.getUtility(IIntIds)
+        return _resolve_in_chunks(self._chunked_ids, intids,
+                                  self.chunk_size, allow_missing)
+
+
+@interface.implementer(IWeakRefToMissing)
+class _IntidWeakRef(object):
+    """
+    A transient weak reference to the object with an intid, used
+    to present compactly stored references.
+    """
+
+    __slots__ = ('doc_id',)
+
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+
+    def __call__(self, allow_cached=True):  # pylint: disable=unused-argument
+        intids = component.queryUtility(IIntIds)
+        return intids.queryObject(self.doc_id) if intids is not None else None
+
+    def __eq__(self, other):
+        return isinstance(other, _IntidWeakRef) and other.doc_id == self.doc_id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.doc_id)
+
+    def make_missing_ntiid(self):
+        return make_ntiid(nttype=TYPE_MISSING, specific=str(self.doc_id))
+
+
+@interface.implementer(IInspectableWeakThreadable,
+                       IMaintainedThreadable)
 class Threadable(object):
     """
     Defines an object that is client-side threadable. These objects are
@@ -39,6 +190,10 @@ class Threadable(object):
     # Our one single parent
     _inReplyTo = None
 
+    # The intid of our parent. This is recorded when inReplyTo
+    # is set, if possible, and by the subscribers when we are added.
+    _inReplyToId = None
+
     # Our chain of references back to the root
     _references = ()
 
@@ -56,6 +211,65 @@ class Threadable(object):
     # Our direct or indirect replies
     _referents = ()
 
+    # If set, the number of shards of a :class:`.ShardedTreeSet`
+    # to hold _referents instead of a single TreeSet. Every reply
+    # anywhere in a thread is added to the referents of its root, so
+    # subclasses whose threads are busy can set this to reduce the
+    # conflicts between concurrent replies. It only affects objects
+    # that don't yet have referents.
+    _referents_shards = None
+
+    # Maintained counts of _replies and _referents. These are conflict
+    # resolving :class:`BTrees.Length.Length` objects kept up to date by
+    # the subscribers, so that counting does not need to touch
+    # (let alone resolve) the intids in the sets. Older objects
+    # may not have them, in which case we fall back to the length of the set.
+    _reply_count = None
+    _referent_count = None
+
+    # A :class:`.MostRecentReply` pointing to the newest of the
+    # _replies, maintained by the subscribers. Older objects may not
+    # have it, in which case we must sort the replies.
+    _most_recent_reply = None
+
+    # The intids of our threadable ancestors, nearest first, up to the
+    # root. Like _references, this only changes when this object is
+    # added, but it is computed by the subscribers (from our parent's
+    # value) rather than trusted from the client. This lets the
+    # subscribers visit the ancestors without resolving the inReplyTo
+    # weak reference of each one. None if it is unknown.
+    _ancestor_ids = None
+
+    # The intid of the root of our thread (our own, if we are a root)
+    # and how far below it we are (0 for the root). Like _ancestor_ids,
+    # these are set by the subscribers when we are added, from the
+    # values of our parent, so that catalogs can index them. None if
+    # they are unknown.
+    _threadRootId = None
+    _threadDepth = None
+
+    # If true, addReference stores the intids of the references in
+    # the tuple _reference_ids (falling back to a weak reference for
+    # objects without one) instead of a weak reference object per
+    # ancestor in the _references list. This is much smaller to
+    # pickle and faster to load for deep threads.
+    _compact_references = False
+    _reference_ids = ()
+
+    # Optional secondary indexes of _replies and _referents ordered
+    # by creation time, holding ``(createdTime, intid)`` keys in an
+    # OOTreeSet. Subclasses that want efficient time-ordered
+    # paging set _maintain_time_index to True and the subscribers
+    # keep them up to date.
+    _maintain_time_index = False
+    _replies_by_time = ()
+    _referents_by_time = ()
+
+    # When iterating replies and referents, resolve this many intids
+    # at a time and prefetch their objects. If 0, resolve (and load)
+    # them one at a time.
+    _prefetch_chunk_size = 100
+
     def __init__(self):  # pylint: disable=useless-super-delegation
         super(Threadable, self).__init__()
 
@@ -75,22 +289,60 @@ class Threadable(object):
 
     def setInReplyTo(self, value):
         self._inReplyTo = IWeakRef(value) if value is not None else None
+        self._inReplyToId = _query_id(value) if value is not None else None
     set_in_reply_to = setInReplyTo
 
     inReplyTo = property(getInReplyTo, setInReplyTo)
 
+    @property
+    def inReplyToId(self):
+        """
+        The intid of the object this is a reply to, if known. This
+        doesn't resolve anything.
+        """
+        return self._inReplyToId
+    in_reply_to_id = inReplyToId
+
+    @property
+    def threadRootId(self):
+        """
+        The intid of the root of the thread this is part of, if known.
+        """
+        return self._threadRootId
+    thread_root_id = threadRootId
+
+    @property
+    def threadDepth(self):
+        """
+        How many replies deep in its thread this is (a root is at depth
+        0), if known.
+        """
+        return self._threadDepth
+    thread_depth = threadDepth
+
     def isOrWasChildInThread(self):
-        return bool(self._inReplyTo is not None or self._references)
+        return bool(self._inReplyTo is not None
+                    or self._references
+                    or self._reference_ids)
     is_or_was_child_in_thread = isOrWasChildInThread
 
     @property
     def references(self):
-        if not self._references:
+        if not self._references and not self._reference_ids:
             return ()
         return list(self.getReferences())
 
+    def _reference_refs(self):
+        """
+        All of our references, in order, as weak references.
+        """
+        refs = list(self._references or ())
+        refs.extend(_IntidWeakRef(ref) if isinstance(ref, Integral) else ref
+                    for ref in self._reference_ids)
+        return refs
+
     def getReferences(self, allow_cached=True):
-        for ref in (self._references or ()):
+        for ref in self._reference_refs():
             try:
                 val = ref(allow_cached=allow_cached)
             except TypeError:  # Not ICachingWeakRef
@@ -101,13 +353,21 @@ class Threadable(object):
     get_references = getReferences
 
     def addReference(self, value):
-        if value is not None:
-            if self._references is Threadable._references:
-                self._references = PersistentList()
-            self._references.append(IWeakRef(value))
+        if value is None:
+            return
+        if self._compact_references:
+            doc_id = _query_id(value)
+            ref = doc_id if doc_id is not None else IWeakRef(value)
+            self._reference_ids += (ref,)
+            return
+        if self._references is Threadable._references:
+            self._references = PersistentList()
+        self._references.append(IWeakRef(value))
     add_reference = addReference
 
     def clearReferences(self):
+        if self._reference_ids:
+            self._reference_ids = ()
         try:
             del self._references[:]
         except TypeError:
@@ -117,16 +377,35 @@ class Threadable(object):
     @property
     def replies(self):
         if self._replies is not Threadable._replies:
-            return IntidResolvingIterable(self._replies,
-                                          allow_missing=True,
-                                          parent=self,
-                                          name='replies')
+            return self._resolving(self._replies, 'replies')
         return ()
 
+    def _resolving(self, ids, name=None):
+        if self._prefetch_chunk_size:
+            return PrefetchingIntidResolvingIterable(ids,
+                                                     allow_missing=True,
+                                                     parent=self,
+                                                     name=name,
+                                                     chunk_size=self._prefetch_chunk_size)
+        return IntidResolvingIterable(ids,
+                                      allow_missing=True,
+                                      parent=self,
+                                      name=name)
+
     @property
     def most_recent_reply(self):
+        pointer = self._most_recent_reply
+        if pointer is not None:
+            if pointer.intid is None:
+                return None
+            intids = component.queryUtility(IIntIds)
+            reply = intids.queryObject(pointer.intid) if intids is not None else None
+            if reply is not None:
+                return reply
+            # The pointer is stale (e.g., a concurrent removal);
+            # answer correctly the slow way.
         direct_replies = sorted((reply for reply in self.replies),
-                                key=lambda x: getattr(x, 'createdTime', 0),
+                                key=_created_time,
                                 reverse=True)
         return direct_replies[0] if direct_replies else None
 
@@ -135,9 +414,88 @@ class Threadable(object):
     @property
     def referents(self):
         if self._referents is not Threadable._referents:
-            return IntidResolvingIterable(self._referents,
-                                          allow_missing=True,
-                                          parent=self,
-                                          name='referents')
+            return self._resolving(self._referents, 'referents')
         return ()
+
+    def _iter_ordered(self, ids, by_time, sort, reverse, start, limit):
+        intids = component.getUtility(IIntIds)
+        if sort is None:
+            keys = ids.keys() if hasattr(ids, 'keys') else list(ids)
+            doc_ids = _window(keys, start, limit, reverse)
+        elif by_time:
+            doc_ids = (key[1] for key in _window(by_time.keys(), start, limit, reverse))
+        else:
+            # No index, we have to load and sort everything
+            everything = sorted(self._resolving(ids), key=_created_time)
+            for obj in _window(everything, start, limit, reverse):
+                yield obj
+            return
+
+        if self._prefetch_chunk_size:
+            for obj in _resolve_in_chunks(doc_ids, intids, self._prefetch_chunk_size):
+                yield obj
+            return
+
+        for doc_id in doc_ids:
+            obj = intids.queryObject(doc_id)
+            if obj is not None:
+                yield obj
+
+    def _ordered(self, ids, by_time, sort, reverse, start, limit):
+        if sort not in (None, 'created'):
+            raise ValueError("Unsupported sort", sort)
+        if not ids:
+            return iter(())
+        return self._iter_ordered(ids, by_time, sort, reverse, start, limit)
+
+    def iterReplies(self, sort='created', reverse=True, start=0, limit=None):
+        """
+        Lazily iterate a page of the direct replies.
+
+        :keyword sort: Either ``'created'`` (the default) to order by
+            ``createdTime``, or ``None`` for intid order.
+        :keyword bool reverse: If true (the default), newest first.
+        :keyword int start: How many replies to skip.
+        :keyword int limit: The maximum number of replies to
+            return, or ``None`` for all of them.
+
+        When the time index is maintained, only the replies in the
+        requested page are loaded. Replies that can no longer be resolved
+        are skipped, so a page may be short.
+        """
+        return self._ordered(self._replies, self._replies_by_time,
+                             sort, reverse, start, limit)
+    iter_replies = iterReplies
+
+    def iterReferents(self, sort='created', reverse=True, start=0, limit=None):
+        """
+        Lazily iterate a page of the direct and indirect replies.
+        See :meth:`iterReplies`.
+        """
+        return self._ordered(self._referents, self._referents_by_time,
+                             sort, reverse, start, limit)
+    iter_referents = iterReferents
+
+    @staticmethod
+    def _count(counter, the_set):
+        if counter is not None:
+            return counter()
+        return len(the_set)
+
+    @property
+    def replyCount(self):
+        """
+        The number of direct replies, without resolving any of them.
+        """
+        return self._count(self._reply_count, self._replies)
+    reply_count = replyCount
+
+    @property
+    def referentCount(self):
+        """
+        The number of direct and indirect replies, without resolving any
+        of them.
+        """
+        return self._count(self._referent_count, self._referents)
+    referent_count = referentCount
 ThreadableMixin = Threadable  # BWC
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Materializing whole threads as trees.
+
+.. $Id$
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+from zope import component
+
+from zope.intid.interfaces import IIntIds
+
+from nti.externalization.externalization import to_external_object
+
+from nti.threadable.externalization import external_ntiid
+from nti.threadable.externalization import external_reference_memo
+
+from nti.threadable.threadable import _created_time
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class ThreadNode(object):
+    """
+    One object in a thread tree produced by :func:`build_thread_tree`.
+    """
+
+    __slots__ = ('object', 'intid', 'depth', 'children')
+
+    def __init__(self, obj, intid, depth=0):
+        self.object = obj
+        self.intid = intid
+        self.depth = depth
+        self.children = []
+
+    def toExternalObject(self, **kwargs):
+        """
+        Externalize this node and its descendants (in a single
+        :func:`.external_reference_memo`).
+        """
+        # Walk with a stack rather than recursing, so a long chain of
+        # replies can't exceed the recursion limit.
+        with external_reference_memo():
+            result = []
+            stack = [(self, result)]
+            while stack:
+                node, siblings = stack.pop()
+                children = []
+                siblings.append({
+                    'Item': to_external_object(node.object, **kwargs),
+                    'Children': children,
+                })
+                stack.extend((x, children) for x in reversed(node.children))
+            return result[0]
+
+    def __iter__(self):
+        """
+        Iterate this node and all its descendants, depth first.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def __repr__(self):
+        return '<%s %s depth=%s children=%s>' % (self.__class__.__name__,
+                                                 self.intid, self.depth,
+                                                 len(self.children))
+
+
+def _parent_id(obj, intids):
+    parent_id = getattr(obj, 'inReplyToId', None)
+    if parent_id is not None:
+        return parent_id
+    inReplyTo = obj.inReplyTo
+    return intids.queryId(inReplyTo) if inReplyTo is not None else None
+
+
+class ThreadNodeView(object):
+    """
+    A small, read-only snapshot of the place of a threadable in its
+    thread. It holds no reference to the threadable, so lists of them
+    can be kept (or cached) without keeping the threadables in memory.
+    See :func:`thread_node_views`.
+    """
+
+    __slots__ = ('intid', 'parentId', 'createdTime', 'replyCount', 'ntiid')
+
+    def __init__(self, intid, parentId, createdTime, replyCount, ntiid):
+        self.intid = intid
+        self.parentId = parentId
+        self.createdTime = createdTime
+        self.replyCount = replyCount
+        self.ntiid = ntiid
+
+    @classmethod
+    def fromThreadable(cls, threadable, intids=None):
+        intids = component.getUtility(IIntIds) if intids is None else intids
+        return cls(intids.queryId(threadable),
+                   _parent_id(threadable, intids),
+                   _created_time(threadable),
+                   getattr(threadable, 'replyCount', 0),
+                   external_ntiid(threadable))
+    from_threadable = fromThreadable
+
+    def toExternalObject(self, **unused_kwargs):
+        return {
+            'NTIID': self.ntiid,
+            'IntId': self.intid,
+            'ParentIntId': self.parentId,
+            'CreatedTime': self.createdTime,
+            'ReplyCount': self.replyCount,
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, ThreadNodeView):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name)
+                   for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %s parent=%s replies=%s>' % (self.__class__.__name__,
+                                                 self.intid, self.parentId,
+                                                 self.replyCount)
+
+
+def thread_node_views(objects, intids=None, deactivate=False):
+    """
+    Snapshot each threadable in *objects* as a :class:`ThreadNodeView`,
+    computing the NTIIDs in a single :func:`.external_reference_memo`.
+
+    :keyword bool deactivate: If true, each persistent threadable
+        without unsaved changes is turned back into a ghost once it has
+        been snapshot, so that building the list doesn't fill the
+        object cache.
+    :return: A list of views.
+    """
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    result = []
+    with external_reference_memo():
+        for obj in objects:
+            result.append(ThreadNodeView.fromThreadable(obj, intids))
+            if deactivate and getattr(obj, '_p_changed', None) is False:
+                obj._p_deactivate()
+    return result
+
+
+def _too_deep(obj, root_id, max_depth):
+    # If the object knows its ancestors, we can tell its depth
+    # without building anything.
+    ancestor_ids = getattr(obj, '_ancestor_ids', None)
+    if max_depth is None or not ancestor_ids or root_id not in ancestor_ids:
+        return False
+    return ancestor_ids.index(root_id) >= max_depth
+
+
+def build_thread_tree(root, max_depth=None, max_nodes=None, intids=None):
+    """
+    Build the tree of *root* and its direct and indirect replies.
+
+    This makes one pass over the referents of *root*, resolving each
+    intid once, and links each object to its parent; the levels of the
+    tree are not walked separately.
+
+    :keyword int max_depth: If given, replies nested deeper than this
+        (the direct replies of *root* are at depth 1) are left out.
+    :keyword int max_nodes: If given, at most this many replies are
+        loaded. If *root* maintains its time index, these are the oldest
+        replies, so their parents are included; otherwise, replies whose
+        parents weren't loaded are left out.
+    :return: The :class:`ThreadNode` for *root*. The children of each
+        node are in order of creation.
+    """
+    # pylint: disable=protected-access
+    intids = component.getUtility(IIntIds) if intids is None else intids
+    root_id = intids.queryId(root)
+    top = ThreadNode(root, root_id)
+
+    by_time = getattr(root, '_referents_by_time', None)
+    if by_time:
+        doc_ids = (key[1] for key in by_time)
+    else:
+        doc_ids = getattr(root, '_referents', ())
+
+    nodes = {root_id: top}
+    parents = {}
+    for doc_id in doc_ids:
+        if max_nodes is not None and len(parents) >= max_nodes:
+            break
+        obj = intids.queryObject(doc_id)
+        if obj is None or _too_deep(obj, root_id, max_depth):
+            continue
+        nodes[doc_id] = ThreadNode(obj, doc_id)
+        parents[doc_id] = _parent_id(obj, intids)
+
+    for doc_id, parent_id in parents.items():
+        parent = nodes.get(parent_id)
+        if parent is not None:
+            parent.children.append(nodes[doc_id])
+
+    # Now set the depths, dropping anything too deep
+    level = [top]
+    while level:
+        next_level = []
+        for node in level:
+            node.children.sort(key=lambda x: _created_time(x.object))
+            if max_depth is not None and node.depth >= max_depth:
+                node.children = []
+            for child in node.children:
+                child.depth = node.depth + 1
+                next_level.append(child)
+        level = next_level
+    return top